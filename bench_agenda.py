@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""
+Agenda pipeline benchmark: build the prompt from synthetic sources, "complete" it with
+the stub LLM backend and type it on the loopback typewriter, all offline.
+
+    python bench_agenda.py [--runs N] [--emails N] [--first-token-ms MS] [--key-ms MS] ...
+
+Reports how long each stage took and the time to the first keystroke, after checking
+that the typeable characters match the firmware and that streamed text is wrapped the
+same as text sent whole.
+"""
+
+############## DEPENDENCIES ##############
+
+import os
+import time
+import random
+import argparse
+import statistics
+from threading import Thread
+from datetime import datetime, timedelta, timezone
+
+# Must be set before underwood_listener opens the port
+os.environ['UNDERWOOD_SERIAL_PORT'] = 'loopback'
+
+import typewriter
+import underwood_listener
+import generate_agenda
+import llm_backend
+
+############## SOURCES ##############
+
+def synthetic_sources(email_count, event_count, news_count):
+    """Make sources shaped like collect_sources() returns, with a mix of important and bulk mail."""
+    now = datetime.now(timezone.utc)
+
+    emails = []
+    for i in range(email_count):
+        bulk = i % 3 != 0
+        headers = [
+            {'name': 'Subject', 'value': f"{'Weekly deals' if bulk else 'Question about the report'} #{i}"},
+            {'name': 'From', 'value': f"Sender {i % 7} <sender{i % 7}@example.com>"},
+            {'name': 'Date', 'value': (now - timedelta(hours=i % 24)).strftime('%a, %d %b %Y %H:%M:%S +0000')}
+        ]
+        if bulk:
+            headers.append({'name': 'List-Unsubscribe', 'value': '<mailto:unsubscribe@example.com>'})
+        emails.append({
+            'id': f'm{i}',
+            'snippet': 'Just checking in about the thing we talked about last week, let me know what you think.',
+            'labelIds': ['INBOX', 'CATEGORY_PROMOTIONS'] if bulk else ['INBOX', 'IMPORTANT'],
+            'internalDate': str(int((now - timedelta(hours=i % 24)).timestamp() * 1000)),
+            'payload': {'headers': headers}
+        })
+
+    events = [{
+        'id': f'e{i}',
+        'updated': now.isoformat(),
+        'summary': f"Meeting {i}",
+        'start': {'dateTime': (now + timedelta(hours=6 * i)).isoformat()}
+    } for i in range(event_count)]
+
+    news = [{
+        'name': f"Local story {i}",
+        'description': 'Something is happening downtown this weekend, and everyone is invited to come along.',
+        'url': f'https://example.com/news/{i}'
+    } for i in range(news_count)]
+
+    return {
+        'emails': emails,
+        'primary_events': events,
+        'additional_events': [],
+        'birthdays': [],
+        'forecast': "Today: Sunny, with a high near 75.\nTonight: Clear, with a low around 55.",
+        'news': news
+    }
+
+############## CHECKS ##############
+
+WRAPPING_SAMPLES = ["Great news 🎉 today", "  [Note]  ", "café — naïve…", "\t", "\r\n", "\n", "👍🏽", " ", "-", "x" * 70]
+
+def check_character_set():
+    """Check that typewriter.TYPEABLE still matches the key matrices in the firmware."""
+    firmware = typewriter.firmware_characters()
+    assert firmware == typewriter.TYPEABLE, (
+        f"typewriter.TYPEABLE is out of step with the firmware: missing {sorted(firmware - typewriter.TYPEABLE)}, "
+        f"extra {sorted(typewriter.TYPEABLE - firmware)}"
+    )
+    print(f"typewriter.TYPEABLE matches the firmware's {len(firmware)} typeable characters")
+
+def check_streaming_wrapper(runs=2000, seed=0):
+    """Check that text streamed in random pieces is wrapped exactly like the same text sent whole."""
+    rng = random.Random(seed)
+    words = llm_backend.CANNED_AGENDA.split(' ') + WRAPPING_SAMPLES
+    mismatches = 0
+    for _ in range(runs):
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(0, 60)))
+        wrapper = underwood_listener.StreamingWrapper()
+        streamed = []
+        i = 0
+        while i < len(text):
+            size = rng.randint(1, 8)
+            streamed += wrapper.feed(text[i:i + size])
+            i += size
+        streamed += wrapper.close()
+        if streamed != list(underwood_listener.wrap_text(text)):
+            mismatches += 1
+    assert not mismatches, f"{mismatches}/{runs} streamed texts wrapped differently from wrap_text()"
+    print(f"Streamed wrapping matches wrap_text() in {runs} random texts")
+
+############## BENCHMARK ##############
+
+def run_once(prefs, sources, backend, stream):
+    """Run the pipeline once and return the duration of each stage in seconds."""
+    port = underwood_listener.arduino
+    typed_before = len(port.typed)
+    first_key = []
+
+    def watch_first_key():
+        # START_TX goes out before the first line, so wait for an actual keystroke
+        while not port.typed[typed_before:].strip(typewriter.START_TX + typewriter.END_TX):
+            time.sleep(0.001)
+        first_key.append(time.monotonic())
+
+    start = time.monotonic()
+    Thread(target=watch_first_key, daemon=True).start()
+
+    messages = generate_agenda.build_messages(prefs, sources)
+    prompt_built = time.monotonic()
+
+    if stream:
+        generate_agenda.stream_to_typewriter(backend.stream(messages))
+    else:
+        text = backend.complete(messages)
+        underwood_listener.send_text(text, wait=False)
+    generated = time.monotonic()
+
+    underwood_listener.output.wait()
+    typed = time.monotonic()
+    while not first_key:
+        time.sleep(0.001)
+
+    return {
+        'prompt': prompt_built - start,
+        'generate': generated - prompt_built,
+        'first key': first_key[0] - start,
+        'total': typed - start
+    }
+
+############## LAUNCHER ##############
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--runs', type=int, default=5)
+    arg_parser.add_argument('--emails', type=int, default=60)
+    arg_parser.add_argument('--events', type=int, default=20)
+    arg_parser.add_argument('--news', type=int, default=10)
+    arg_parser.add_argument('--budget', type=int, default=None, help="prompt token budget")
+    arg_parser.add_argument('--first-token-ms', type=float, default=500, help="simulated LLM latency")
+    arg_parser.add_argument('--chars-per-second', type=float, default=400, help="simulated LLM output rate")
+    arg_parser.add_argument('--key-ms', type=float, default=0, help="simulated time to type a key")
+    arg_parser.add_argument('--return-ms', type=float, default=0, help="simulated time for a carriage return")
+    arg_parser.add_argument('--no-stream', action='store_true', help="wait for the whole completion before typing")
+    args = arg_parser.parse_args()
+
+    check_character_set()
+    check_streaming_wrapper()
+
+    underwood_listener.connect()
+    underwood_listener.arduino.seconds_per_key = args.key_ms / 1000
+    underwood_listener.arduino.seconds_per_return = args.return_ms / 1000
+    Thread(target=underwood_listener.receive_typed_text, daemon=True).start()
+
+    prefs = {'fname': 'Andrew', 'city': 'Chicago', 'state': 'Illinois'}
+    if args.budget is not None:
+        prefs['prompt_token_budget'] = args.budget
+    sources = synthetic_sources(args.emails, args.events, args.news)
+    backend = llm_backend.StubBackend(first_token_delay=args.first_token_ms / 1000, chars_per_second=args.chars_per_second)
+
+    results = [run_once(prefs, sources, backend, not args.no_stream) for _ in range(args.runs)]
+
+    print(f"{args.runs} runs, {'non-' if args.no_stream else ''}streaming, overflowed {underwood_listener.arduino.overflowed} bytes")
+    for stage in results[0]:
+        times = [result[stage] * 1000 for result in results]
+        print(f"    {stage:>10}: median {statistics.median(times):8.1f} ms  min {min(times):8.1f} ms  max {max(times):8.1f} ms")
+
+if __name__ == "__main__":
+    main()
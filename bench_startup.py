@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+Startup benchmark: import each entry point in a fresh interpreter with `-X importtime`
+and report its total import time and the slowest modules it pulled in.
+
+    python bench_startup.py [--top N] [--budget-ms MS] [module ...]
+
+Exits non-zero if any entry point takes longer than --budget-ms to import.
+"""
+
+############## DEPENDENCIES ##############
+
+import os
+import sys
+import argparse
+import subprocess
+
+ENTRY_POINTS = ['underwood_ctl', 'generate_agenda', 'underwood_listener', 'get_connected']
+
+############## BENCHMARK ##############
+
+def import_times(module):
+    """Import `module` in a fresh interpreter and return [(cumulative_us, self_us, name)]."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        # import time:       self [us] |    cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return times
+
+def report(module, top):
+    """Print the import profile for one module and return its total import time in ms."""
+    times = import_times(module)
+    # The entry point itself is the last top-level (unindented) import
+    total_us = next(cumulative for cumulative, _, name in reversed(times) if name.strip() == module)
+
+    print(f"{module}: {total_us / 1000:.1f} ms, {len(times)} modules")
+    for cumulative, self_us, name in sorted(times, key=lambda t: t[1], reverse=True)[:top]:
+        print(f"    {self_us / 1000:8.1f} ms self {cumulative / 1000:8.1f} ms cumulative  {name.strip()}")
+    return total_us / 1000
+
+############## LAUNCHER ##############
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('modules', nargs='*', default=ENTRY_POINTS)
+    arg_parser.add_argument('--top', type=int, default=10, help="how many of the slowest imports to list")
+    arg_parser.add_argument('--budget-ms', type=float, default=None, help="fail if any entry point is slower")
+    args = arg_parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        total_ms = report(module, args.top)
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            over_budget.append(module)
+
+    if over_budget:
+        print(f"Over the {args.budget_ms:.0f} ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+In-process connectivity monitor, replacing a forked `ping` per check.
+
+The online/offline state is cached and refreshed by a TCP connect to the hosts the
+agenda actually needs. A netlink socket listens for link, address and route changes
+so the state is re-probed as soon as the network changes, rather than when the cache
+next expires. Call add_listener() to hear about changes, or wait_for() to block until
+the device is online (or offline).
+"""
+
+############## DEPENDENCIES ##############
+
+import time
+import socket
+from queue import Queue, Empty
+from threading import Thread, Lock, Condition
+
+############## PROBE ##############
+
+PROBE_HOSTS = [
+    ('www.googleapis.com', 443),
+    ('api.openai.com', 443),
+    ('api.weather.gov', 443)
+]
+PROBE_TIMEOUT = 2  # seconds
+ONLINE_TTL = 60  # How long an online result is trusted, in seconds
+OFFLINE_TTL = 5
+DEBOUNCE = 1  # Network changes arrive in bursts; probe once they settle
+
+resolved = {}  # (host, port) -> (family, sockaddr) it last resolved to, so probes don't wait on DNS
+
+def can_connect(address, timeout=PROBE_TIMEOUT):
+    """
+    Try opening (and immediately closing) a TCP connection to `address`, at its cached IP
+    if there is one. Only the first probe of a host (or one after a failure) resolves it.
+    """
+    try:
+        target = resolved.get(address)
+        if target is None:
+            host, port = address
+            family, _, _, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+            target = (family, sockaddr)
+        with socket.socket(target[0], socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(target[1])
+        resolved[address] = target
+        return True
+    except OSError:
+        # The IP may have moved; look the host up again next time
+        resolved.pop(address, None)
+        return False
+
+def probe(hosts=PROBE_HOSTS, timeout=PROBE_TIMEOUT):
+    """
+    Return True as soon as any of `hosts` accepts a connection, or False if none do
+    within `timeout`. A lookup stuck on unreachable DNS is left behind, not waited for.
+    """
+    deadline = time.monotonic() + timeout
+    results = Queue()
+    for address in hosts:
+        Thread(target=lambda address=address: results.put(can_connect(address, timeout)), daemon=True).start()
+    for _ in hosts:
+        try:
+            if results.get(timeout=max(0, deadline - time.monotonic())):
+                return True
+        except Empty:
+            return False
+    return False
+
+############## NETLINK ##############
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+def open_netlink():
+    """Subscribe to link, address and route changes, or return None where netlink isn't available."""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+        return sock
+    except (AttributeError, OSError) as e:
+        print(f"Couldn't listen for network changes: {e}")
+        return None
+
+############## MONITOR ##############
+
+class ConnectivityMonitor:
+
+    def __init__(self, hosts=PROBE_HOSTS):
+        self.hosts = hosts
+        self.online = None  # Unknown until the first probe
+        self.checked_at = 0
+        self.probing = False
+        self.listeners = []
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.started = False
+
+    def start(self):
+        """Watch for network changes from a background thread."""
+        with self.lock:
+            if self.started:
+                return self
+            self.started = True
+        Thread(target=self.watch_netlink, daemon=True).start()
+        return self
+
+    def is_online(self, fresh=False):
+        """
+        Return the cached connectivity state without blocking, refreshing it in the
+        background once it's stale. Only probes in the foreground if the state is
+        unknown, `fresh` is asked for, or a stale "offline" would send the user off to
+        set up Wi-Fi.
+        """
+        with self.lock:
+            online = self.online
+            ttl = ONLINE_TTL if online else OFFLINE_TTL
+            stale = time.monotonic() - self.checked_at > ttl
+
+        if fresh or online is None or (stale and not online):
+            return self.check()
+        if stale:
+            self.check_in_background()
+        return online
+
+    def check(self):
+        """Probe now and update the cached state."""
+        online = probe(self.hosts)
+        self.update(online)
+        return online
+
+    def check_in_background(self, delay=0):
+        with self.lock:
+            if self.probing:
+                return
+            self.probing = True
+
+        def run():
+            try:
+                time.sleep(delay)
+                self.check()
+            finally:
+                with self.lock:
+                    self.probing = False
+
+        Thread(target=run, daemon=True).start()
+
+    def update(self, online):
+        with self.lock:
+            previous = self.online
+            self.online = online
+            self.checked_at = time.monotonic()
+            self.changed.notify_all()
+            listeners = list(self.listeners)
+
+        if previous is not None and previous != online:
+            print(f"Connectivity changed: {'online' if online else 'offline'}")
+            for listener in listeners:
+                try:
+                    listener(online)
+                except Exception as e:
+                    print(f"An error occurred in a connectivity listener: {str(e)}")
+
+    def add_listener(self, listener):
+        """Call listener(online) whenever the device goes online or offline."""
+        with self.lock:
+            self.listeners.append(listener)
+
+    def wait_for(self, online=True, timeout=None):
+        """Block until the device is `online` (or offline), up to `timeout` seconds. Returns whether it is."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.check() != online:
+            remaining = OFFLINE_TTL if deadline is None else min(OFFLINE_TTL, deadline - time.monotonic())
+            if remaining <= 0:
+                return False
+            # A probe after a network change wakes this early; otherwise poll
+            with self.lock:
+                if self.changed.wait_for(lambda: self.online == online, timeout=remaining):
+                    return True
+        return True
+
+    def watch_netlink(self):
+        sock = open_netlink()
+        if sock is None:
+            return
+        with sock:
+            while True:
+                try:
+                    sock.recv(65536)
+                except OSError as e:
+                    print(f"Stopped listening for network changes: {e}")
+                    return
+                # The details don't matter; any change means the cached state may be wrong
+                with self.lock:
+                    self.checked_at = 0
+                self.check_in_background(DEBOUNCE)
+
+monitor = ConnectivityMonitor()
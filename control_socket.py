@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+############## DEPENDENCIES ##############
+
+import os
+import json
+import socket
+import socketserver
+from threading import Thread
+
+############## CONTROL SOCKET ##############
+
+# The listener daemon accepts one-line commands ('agenda', 'status', 'cancel') on this
+# socket and answers each with one line of JSON.
+CONTROL_SOCKET_PATH = os.getenv('UNDERWOOD_CONTROL_SOCKET', '/run/underwood.sock')
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, commands, path=CONTROL_SOCKET_PATH):
+        self.commands = commands
+        self.path = path
+        # Clear out a socket left behind by a previous run
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, ControlHandler)
+        os.chmod(path, 0o660)
+
+    def start(self):
+        """Serve commands from a background thread."""
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class ControlHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        command = self.rfile.readline().decode('utf-8').strip()
+        handler = self.server.commands.get(command)
+        if handler is None:
+            response = {'ok': False, 'error': f"Unknown command '{command}'"}
+        else:
+            try:
+                response = {'ok': True, **(handler() or {})}
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+def send_command(command, path=CONTROL_SOCKET_PATH, timeout=5):
+    """Send a command to the listener daemon and return its response; raises OSError if it isn't running."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall((command + '\n').encode('utf-8'))
+        response = b''
+        while not response.endswith(b'\n'):
+            data = client.recv(4096)
+            if not data:
+                break
+            response += data
+    return json.loads(response.decode('utf-8'))
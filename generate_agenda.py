@@ -1,108 +1,108 @@
 ############## EXTERNAL FUNCTIONS ##############
 
 import underwood_listener
-import get_connected
+import control_socket
+import http_client
+import google_services
+import google_credentials
+import prompt_budget
+import llm_backend
+import snapshot_store
+from preferences import load_preferences, atomic_write_json
 
 ############## DEPENDENCIES ##############
 
+# Heavy libraries (googleapiclient, openai, requests, dateutil) are imported
+# where they're first used, so the cron-launched agenda starts quickly.
+
 #SYS
 
 from datetime import datetime, timedelta
+from contextlib import contextmanager
 import time
 import os
-import serial
-import sys
-import subprocess
-from crontab import CronTab
-from threading import Thread
-from dateutil import parser
-from dateutil.tz import tzlocal
-import pytz
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from dotenv import load_dotenv
 load_dotenv()
 
 #API
 
 import re
-import requests
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import socketserver
-from urllib.parse import urlparse, parse_qs
-import pickle
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from openai import OpenAI
+import hashlib
+import sqlite3
+from email.utils import parsedate_to_datetime
 
 #TXT
 
 import json
-import textwrap
-from textwrap import fill
-import emoji
-
-def load_preferences():
-    """Load preferences from a JSON file, create the file with default settings if it does not exist."""
-    prefs_path = '/home/underwood/prefs.json'
-
-    default_prefs = {
-        'first_boot': True,
-        'lat': None,
-        'lng': None,
-        'fname': None,
-        'lname': None,
-        'city': None,
-        'state': None
-    }
 
-    if os.path.exists(prefs_path):
-        # Check if the file is blank
-        if os.path.getsize(prefs_path) == 0:
-            # Write default preferences to the file if it is blank
-            with open(prefs_path, 'w') as file:
-                json.dump(default_prefs, file, indent=4)
-            return default_prefs
-        else:
-            # Load and return preferences if the file exists and is not blank
-            with open(prefs_path, 'r') as file:
-                return json.load(file)
-    else:
-        # Create the prefs.json file with default preferences if it does not exist
-        with open(prefs_path, 'w') as file:
-            json.dump(default_prefs, file, indent=4)
-        return default_prefs
-
-def save_preferences(preferences):
-    """Save preferences to the JSON file."""
-    with open('/home/underwood/prefs.json', 'w') as file:
-        json.dump(preferences, file, indent=4)
-
-prefs = load_preferences()
-
-def custom_translate(text):
-    # Create a translation table for specific characters you want to replace
-    translation_table = str.maketrans({
-        '[': '(',
-        ']': ')'
-    })
-    text = emoji.replace_emoji(text, replace=' ')
-    text = text.translate(translation_table)
-    text = text.replace('  ', ' ')
-    return text
+############## TIMING ##############
+
+@contextmanager
+def timed(stage):
+    """Print how long a stage of the agenda pipeline took."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        print(f"[timing] {stage}: {time.monotonic() - start:.2f}s")
+
+############## WEATHER ##############
+
+FORECAST_CACHE_PATH = '/home/underwood/forecast_cache.json'
+
+def load_forecast_cache():
+    """Load the cached NWS forecast URL and payload, or an empty cache if there isn't one."""
+    try:
+        with open(FORECAST_CACHE_PATH, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_forecast_cache(cache):
+    """Write the forecast cache atomically so a crash can't leave a half-written file."""
+    try:
+        atomic_write_json(FORECAST_CACHE_PATH, cache)
+    except OSError as e:
+        print(f"Error saving forecast cache: {e}")
+
+def forecast_location():
+    """Return the rounded (lat, lng) used for NWS lookups, defaulting to downtown Chicago."""
+    prefs = load_preferences()
+    lat = prefs.get('lat') or 41.8781
+    lng = prefs.get('lng') or -87.6298
+    return round(lat, 4), round(lng, 4)
+
+def cache_lifetime(response):
+    """Return how many seconds a response may be reused, per its Cache-Control or Expires header."""
+    match = re.search(r'(?<![-\w])max-age=(\d+)', response.headers.get('Cache-Control', ''))
+    if match:
+        return int(match.group(1))
+
+    expires = response.headers.get('Expires')
+    if expires:
+        try:
+            return max(0, parsedate_to_datetime(expires).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return 0
 
 def get_forecast_url():
     """Get the forecast URL from the National Weather Service API, adjusting lat/lng granularity."""
-    prefs = load_preferences()
+    import requests
 
-    try:
-        # Get lat and lng from preferences or default to downtown Chicago
-        lat = prefs.get('lat', 41.8781)
-        lng = prefs.get('lng', -87.6298)
+    lat, lng = forecast_location()
+    location = f"{lat},{lng}"
 
-        lat, lng = round(lat, 4), round(lng, 4)
+    # The forecast office & grid only change when the location does
+    cache = load_forecast_cache()
+    if cache.get('location') == location and cache.get('forecast_url'):
+        return cache['forecast_url']
+
+    try:
         point_url = f"https://api.weather.gov/points/{lat},{lng}"
-        response = requests.get(point_url)
+        response = http_client.get(point_url)
         response.raise_for_status()  # Raises an HTTPError for bad responses
         response_data = response.json()
         forecast_url = response_data.get('properties', {}).get('forecast')
@@ -110,19 +110,31 @@ def get_forecast_url():
         if not forecast_url:
             raise ValueError("Forecast URL not found in the response.")
         
+        # A new location invalidates any forecast cached for the old one
+        save_forecast_cache({'location': location, 'forecast_url': forecast_url})
         return forecast_url
     except (requests.RequestException, ValueError) as e:
         print(f"Error retrieving forecast URL: {e}")
         return None
 
+def format_forecast(periods):
+    """Format the top 3 forecast periods, regardless of their specific names."""
+    return "\n".join(f"{period.get('name')}: {period.get('detailedForecast')}" for period in periods[:3])
+
 def get_forecast():
-    """Get forecasts for the top 3 periods, regardless of their specific names."""
+    """Get forecasts for the top 3 periods, reusing the last payload until NWS says it has expired."""
+    import requests
+
     forecast_url = get_forecast_url()
     if not forecast_url:
         return "Forecast is currently unavailable."
 
+    cache = load_forecast_cache()
+    if cache.get('forecast_url') == forecast_url and cache.get('periods') and cache.get('expires_at', 0) > time.time():
+        return format_forecast(cache['periods'])
+
     try:
-        response = requests.get(forecast_url)
+        response = http_client.get(forecast_url)
         response.raise_for_status()  # Ensure we got a good response
         forecast_data = response.json()
         periods = forecast_data.get('properties', {}).get('periods', [])
@@ -130,21 +142,25 @@ def get_forecast():
         if not periods:
             return "No forecast data available."
 
-        top_forecasts = periods[:3]  # Get the top 3 periods
-        forecasts = []
-        for period in top_forecasts:
-            forecasts.append({
-                'name': period.get('name'),
-                'detailedForecast': period.get('detailedForecast')
-            })
-        
-        forecast_str = "\n".join(f"{forecast['name']}: {forecast['detailedForecast']}" for forecast in forecasts)
-        return forecast_str
+        top_forecasts = [{
+            'name': period.get('name'),
+            'detailedForecast': period.get('detailedForecast')
+        } for period in periods[:3]]  # Get the top 3 periods
+
+        cache['periods'] = top_forecasts
+        cache['expires_at'] = time.time() + cache_lifetime(response)
+        save_forecast_cache(cache)
+
+        return format_forecast(top_forecasts)
     except requests.RequestException as e:
         print(f"Error retrieving forecast: {e}")
         return "Forecast unavailable."
 
+############## NEWS ##############
+
 def get_local_news():
+    """Return today's local news stories from Bing as a list of {name, description, url} dicts."""
+    prefs = load_preferences()
 
     base_url = "https://api.bing.microsoft.com/v7.0/news/search"
     headers = {"Ocp-Apim-Subscription-Key": os.getenv('BING_KEY')}
@@ -156,141 +172,632 @@ def get_local_news():
         "freshness": "Day"
     }
 
-    response = requests.get(base_url, headers=headers, params=params)
+    response = http_client.get(base_url, headers=headers, params=params)
 
     if response.status_code == 200:
         news_items = response.json().get('value', [])
-        news_str = ""
-        for i, item in enumerate(news_items, start=1):
-            news_str += f"{item.get('name')}: {item.get('description')}\n"
+        return [{
+            'name': item.get('name'),
+            'description': item.get('description'),
+            'url': item.get('url')
+        } for item in news_items]
+    return []
+
+############## GMAIL ##############
+
+# List-Unsubscribe, Precedence and Auto-Submitted help prompt_budget spot bulk and automated mail
+GMAIL_METADATA_HEADERS = ['Subject', 'From', 'Date', 'List-Unsubscribe', 'List-Id', 'Precedence', 'Auto-Submitted']
+GMAIL_BATCH_SIZE = 50  # Gmail recommends no more than 50 calls per batch
+GMAIL_INDEX_PATH = '/home/underwood/gmail_index.json'
+GMAIL_RETRIES = 3  # Times to retry messages whose fetch failed
+GMAIL_RETRY_DELAY = 1  # seconds before the first retry, doubling after each one
+
+# The local index holds the metadata of every inbox message since the agenda window
+# started, plus the account and mailbox historyId it's current as of, so later runs only
+# fetch what has changed. Messages that couldn't be fetched stay 'pending' and are
+# fetched again by the next sync.
+gmail_index_lock = Lock()
+
+def list_message_ids(service, query):
+    """Page through messages().list and return the ID of every matching message."""
+    message_ids = []
+    page_token = None
+    while True:
+        results = service.users().messages().list(userId='me', q=query, pageToken=page_token, maxResults=500).execute()
+        message_ids.extend(message['id'] for message in results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return message_ids
+
+def fetch_message_metadata(service, message_ids):
+    """
+    Fetch Subject/From/Date headers, labels and received time for the given messages using
+    batched requests, retrying the ones that fail (e.g. rate limited) with backoff. Returns
+    the messages and the IDs that still couldn't be fetched.
+    """
+    responses = {}
+    failed = {}
+
+    def handle_response(request_id, response, exception):
+        if exception is None:
+            responses[request_id] = response
+            failed.pop(request_id, None)
+        elif getattr(getattr(exception, 'resp', None), 'status', None) == 404:
+            failed.pop(request_id, None)  # Deleted since it was listed
+        else:
+            failed[request_id] = exception
+
+    remaining = list(message_ids)
+    for attempt in range(GMAIL_RETRIES + 1):
+        if attempt:
+            time.sleep(GMAIL_RETRY_DELAY * 2 ** (attempt - 1))
+        for i in range(0, len(remaining), GMAIL_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=handle_response)
+            for message_id in remaining[i:i + GMAIL_BATCH_SIZE]:
+                batch.add(service.users().messages().get(
+                    userId='me',
+                    id=message_id,
+                    format='metadata',
+                    metadataHeaders=GMAIL_METADATA_HEADERS,
+                    fields='id,snippet,labelIds,internalDate,payload/headers'
+                ), request_id=message_id)
+            batch.execute()
+        remaining = [message_id for message_id in remaining if message_id in failed]
+        if not remaining:
+            break
+
+    for message_id in remaining:
+        print(f"Error fetching message {message_id}: {failed[message_id]}")
+
+    # Keep the order messages().list returned them in
+    return [responses[message_id] for message_id in message_ids if message_id in responses], remaining
+
+def email_window():
+    """Return the (start, end) of the agenda's email window in epoch milliseconds: all of yesterday."""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    yesterday = today - timedelta(days=1)
+    return int(yesterday.timestamp() * 1000), int(today.timestamp() * 1000)
+
+def load_gmail_index():
+    """Load the local Gmail index, or an empty one if there isn't one."""
+    try:
+        with open(GMAIL_INDEX_PATH, 'r') as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        index = {}
+    index.setdefault('account', None)
+    index.setdefault('history_id', None)
+    index.setdefault('messages', {})
+    index.setdefault('pending', [])
+    return index
+
+def save_gmail_index(index):
+    """Write the Gmail index in place of the old one."""
+    try:
+        atomic_write_json(GMAIL_INDEX_PATH, index, separators=(',', ':'))
+    except OSError as e:
+        print(f"Error saving Gmail index: {e}")
+
+def full_sync(service, index, history_id):
+    """
+    Rebuild the index from a messages().list query for everything since the agenda window
+    started, up to now. `history_id` must have been read before the listing starts, so
+    nothing that arrives during it is missed.
+    """
+    window_start, _ = email_window()
+    query = f'label:inbox after:{window_start // 1000}'
+
+    with timed("gmail list"):
+        message_ids = list_message_ids(service, query)
+    with timed(f"gmail metadata ({len(message_ids)} messages)"):
+        messages, failed = fetch_message_metadata(service, message_ids)
+
+    index['history_id'] = history_id
+    index['messages'] = {msg['id']: msg for msg in messages}
+    index['pending'] = failed
+
+def incremental_sync(service, index):
+    """
+    Apply the mailbox changes since the index's historyId. Returns False if Gmail no
+    longer has history that far back, in which case the index needs a full sync.
+    """
+    from googleapiclient.errors import HttpError
+
+    messages = index['messages']
+    to_fetch = set(index['pending'])
+    history_id = index['history_id']
+    page_token = None
+
+    with timed("gmail history"):
+        while True:
+            try:
+                results = service.users().history().list(
+                    userId='me',
+                    startHistoryId=index['history_id'],
+                    historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                    pageToken=page_token,
+                    maxResults=500
+                ).execute()
+            except HttpError as e:
+                if e.resp.status == 404:
+                    return False
+                raise
+
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    if 'INBOX' in added['message'].get('labelIds', []):
+                        to_fetch.add(added['message']['id'])
+                for deleted in record.get('messagesDeleted', []):
+                    messages.pop(deleted['message']['id'], None)
+                    to_fetch.discard(deleted['message']['id'])
+                for change in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                    message_id = change['message']['id']
+                    labels = change['message'].get('labelIds', [])
+                    if message_id in messages:
+                        messages[message_id]['labelIds'] = labels
+                    elif 'INBOX' in labels:
+                        # e.g. moved back to the inbox
+                        to_fetch.add(message_id)
+
+            history_id = results.get('historyId', history_id)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+    failed = []
+    if to_fetch:
+        with timed(f"gmail metadata ({len(to_fetch)} new messages)"):
+            fetched, failed = fetch_message_metadata(service, sorted(to_fetch))
+            for msg in fetched:
+                messages[msg['id']] = msg
+    index['pending'] = failed
+
+    index['history_id'] = history_id
+    return True
+
+def sync_inbox(service):
+    """Bring the local Gmail index up to date and return its messages, keyed by ID."""
+    with gmail_index_lock:
+        index = load_gmail_index()
+
+        # The index belongs to one mailbox, so start over if another account has signed in
+        profile = service.users().getProfile(userId='me').execute()
+        if index['account'] != profile['emailAddress']:
+            index = {'account': profile['emailAddress'], 'history_id': None, 'messages': {}, 'pending': []}
+
+        if not index['history_id'] or not incremental_sync(service, index):
+            full_sync(service, index, profile['historyId'])
+
+        # Evict anything older than the agenda window so the index stays small
+        window_start, _ = email_window()
+        index['messages'] = {
+            message_id: msg for message_id, msg in index['messages'].items()
+            if int(msg.get('internalDate', 0)) >= window_start
+        }
+        save_gmail_index(index)
+        return index['messages']
+
+def inbox_messages(messages, start, end=None):
+    """Return the inbox messages received between `start` and `end` (epoch ms), newest first."""
+    selected = [
+        msg for msg in messages.values()
+        if 'INBOX' in msg.get('labelIds', [])
+        and int(msg.get('internalDate', 0)) >= start
+        and (end is None or int(msg.get('internalDate', 0)) < end)
+    ]
+    return sorted(selected, key=lambda msg: int(msg.get('internalDate', 0)), reverse=True)
+
+def header_value(msg, name, default=None):
+    """Return the value of a message header fetched with format='metadata'."""
+    return next((header['value'] for header in msg['payload']['headers'] if header['name'] == name), default)
+
+def fetch_new_emails(service, since):
+    """Return a short line for each inbox message received after the `since` timestamp."""
+    messages = inbox_messages(sync_inbox(service), int(since * 1000))
+    return [f"{header_value(msg, 'From', 'Unknown Sender')}: {header_value(msg, 'Subject', 'No Subject')}" for msg in messages]
+
+def format_email(msg):
+    """Format a metadata-only message as a single line for the GPT prompt."""
+    from dateutil import parser
+    from dateutil.tz import tzlocal
+
+    subject = header_value(msg, 'Subject', 'No Subject')
+    sender = header_value(msg, 'From', 'Unknown Sender')
+    date_str = header_value(msg, 'Date')
+
+    if date_str:
+        # Parse the date string and convert it to local timezone
+        date_received = parser.parse(date_str)
+        local_date = date_received.astimezone(tzlocal())
+        date_display = local_date.strftime("%A, %d %B %Y %H:%M:%S %Z")
+    else:
+        date_display = 'No Date'
+    snippet = msg.get('snippet', '')
+    return f"Sender: {sender}, Subject: {subject}, Date Received: {date_display}, Preview: {snippet}"
+
+def fetch_emails(service):
+    """Return the metadata of every inbox message received yesterday, newest first."""
+    messages = sync_inbox(service)
+    return inbox_messages(messages, *email_window())
+
+############## CALENDAR ##############
+
+HOLIDAY_CALENDAR_ID = '6lqpbv8647igscie1ictda2c57nigmcn@import.calendar.google.com' # public US holidays & observances
+BIRTHDAY_CALENDAR_ID = 'addressbook#contacts@group.v.calendar.google.com' # contacts' birthdays
+
+def fetch_events(calendar_service, calendar_id, start_time, end_time):
+    """Fetch events from a calendar between two RFC 3339 timestamps."""
+    events_result = calendar_service.events().list(
+        calendarId=calendar_id,
+        timeMin=start_time,
+        timeMax=end_time,
+        singleEvents=True,
+        orderBy='startTime'
+    ).execute()
+    return events_result.get('items', [])
+
+############## SOURCES ##############
+
+def gather_sources(fetchers):
+    """
+    Run independent data fetchers concurrently.
+
+    `fetchers` maps a source name to a (function, fallback, timeout) tuple. A source that
+    raises, or hasn't finished within `timeout` seconds of the fan-out starting, is replaced
+    by its fallback so one slow API can't hold up (or kill) the whole agenda.
+    """
+    def run(name, fetch):
+        with timed(name):
+            return fetch()
+
+    executor = ThreadPoolExecutor(max_workers=len(fetchers))
+    start = time.monotonic()
+    futures = {name: executor.submit(run, name, fetch) for name, (fetch, fallback, timeout) in fetchers.items()}
+
+    results = {}
+    for name, (fetch, fallback, timeout) in fetchers.items():
+        remaining = max(0, start + timeout - time.monotonic())
+        try:
+            results[name] = futures[name].result(timeout=remaining)
+        except FutureTimeout:
+            print(f"Timed out fetching {name} after {timeout}s")
+            results[name] = fallback
+        except Exception as e:
+            print(f"Error fetching {name}: {e}")
+            results[name] = fallback
+
+    # Don't wait on stragglers; their results are no longer needed
+    executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+############## OUTPUT ##############
+
+STREAM_FAILED_NOTE = "\nI'm sorry, I lost my train of thought! Hit the EXPR key and I'll start over."
+
+def stream_to_typewriter(deltas):
+    """
+    Type streamed text line by line while the rest of it is still being generated.
+    Returns the whole text, or None if the output was canceled or generation failed
+    part way through.
+    """
+    received = []
+    finished = False
+
+    def lines():
+        nonlocal finished
+        start = time.monotonic()
+        first_line = True
+        wrapper = underwood_listener.StreamingWrapper()
+        try:
+            for delta in deltas:
+                received.append(delta or '')
+                for line in wrapper.feed(delta or ''):
+                    if first_line:
+                        print(f"[timing] first line: {time.monotonic() - start:.2f}s")
+                        first_line = False
+                    yield line
+        except Exception as e:
+            # e.g. the API timed out or the connection dropped; say so rather than just stopping
+            print(f"The agenda stopped generating part way through: {e}")
+            yield from wrapper.close()
+            yield from underwood_listener.wrap_text(STREAM_FAILED_NOTE)
+            return
+        yield from wrapper.close()
+        finished = True
+
+    # The output engine types each line as soon as it's queued
+    underwood_listener.send_lines(lines(), wait=False)
+    return ''.join(received) if finished else None
+
+def load_credentials(message_queue):
+    """
+    Return the Google credentials, asking the user to sign in if there aren't any. Without
+    a message_queue (e.g. when prefetching) there's nobody to sign in, so return None
+    rather than starting the OAuth flow.
+    """
+    import get_connected
+
+    credentials = google_credentials.manager.get()
+    if credentials is None and message_queue is not None:
+        credentials = get_connected.get_credentials(message_queue)
+    return credentials
+
+def collect_sources(credentials):
+    """Fetch emails from the past 24 hours, events for the next 7 days and local weather & news highlights, all at once."""
+    # Calendar functionality to fetch events for the next 7 days
+    start_time = datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
+    end_time = (datetime.utcnow() + timedelta(days=7)).isoformat() + 'Z'
+
+    # The clients are shared, but each thread's requests go out on that thread's own connection
+    def fetch_calendar(calendar_id):
+        calendar_service = google_services.get_service('calendar', 'v3', credentials)
+        return fetch_events(calendar_service, calendar_id, start_time, end_time)
+
+    fetchers = {
+        'emails': (lambda: fetch_emails(google_services.get_service('gmail', 'v1', credentials)), [], 30),
+        'primary_events': (lambda: fetch_calendar('primary'), [], 15),
+        'additional_events': (lambda: fetch_calendar(HOLIDAY_CALENDAR_ID), [], 15),
+        'birthdays': (lambda: fetch_calendar(BIRTHDAY_CALENDAR_ID), [], 15),
+        'forecast': (get_forecast, "Forecast unavailable.", 15),
+        'news': (get_local_news, [], 15)
+    }
+    with timed("sources"):
+        sources = gather_sources(fetchers)
+
+    # Keep a local copy for offline agendas, without clobbering it with the fallbacks
+    failed = {name for name, (fetch, fallback, timeout) in fetchers.items() if sources[name] is fallback}
+    Thread(target=save_snapshot, args=(sources, failed), daemon=True).start()
+    return sources
+
+def save_snapshot(sources, failed):
+    try:
+        with timed("snapshot"):
+            snapshot_store.save_snapshot(sources, skip=failed)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Failed to save the offline snapshot: {e}")
+
+def format_event(event):
+    start = event['start'].get('dateTime', event['start'].get('date'))
+    return f"Event: {event['summary']}, Start: {start}"
+
+def format_news(item):
+    return f"{item.get('name')}: {item.get('description')}"
+
+def build_messages(prefs, sources):
+    """Build the chat messages asking GPT to write the agenda from the collected sources."""
+    forecast_str = sources['forecast']
+
+    # Rank everything and keep what fits in the prompt's token budget
+    calendar_weights = [('primary_events', 1.0), ('additional_events', 0.6), ('birthdays', 0.7)]
+    all_events = [(event, weight) for name, weight in calendar_weights for event in sources[name]]
+    packed = prompt_budget.pack({
+        'emails': [(score, format_email(msg)) for score, msg in prompt_budget.rank_emails(sources['emails'])],
+        'events': [(score, format_event(event)) for score, event in prompt_budget.rank_events(all_events)],
+        'news': [(score, format_news(item)) for score, item in prompt_budget.rank_news(sources['news'] or [])]
+    }, prefs.get('prompt_token_budget', prompt_budget.TOKEN_BUDGET))
+        
+    if prefs['fname']:
+        name_prompt = f"I'm {prefs['fname']}. "
+    else:
+        name_prompt = "" 
     
-        return(news_str)
+    # Get today's date
+    today = datetime.now().strftime("%A, %B %d, %Y, and it's around %-I %p")
+    
+    email_details = "\n".join(packed['emails'])
+    cal_details = "\n".join(packed['events'])
+    news_str = "".join(line + "\n" for line in packed['news'])
+    
+    user_message = f"Today is {today}. {name_prompt}You're my executive assistant Mr. Underwood. You're a little quirky and goofy. Write me a quick, concise, chipper, friendly note updating me on my agenda. Don't offer any follow-up help. Avoid using non-ASCII characters. Include the date. Be concise - time is money - but include a motivational quote. Mention any important emails from the below list (ignore promotional emails, and focus on things I need to deal with), identify any upcoming holidays, mention any upcoming events from my calendar, and weave in any relevant highlights from the forecast and or/local news, if they seem important and worthy of my busy schedule, from any provided below (ignore any blank sections):\n\nEMAILS:\n\n{email_details}\n\nCALENDAR EVENTS:\n\n{cal_details}\n\n WEATHER:\n{forecast_str}\n\n {prefs['city'].upper()} NEWS:\n{news_str}"
+        
+    # Prepare the chat messages
+    return [
+        {"role": "system", "content": "You are my helpful executive assistant."},
+        {"role": "user", "content": user_message}
+    ]
 
 def generate_agenda(message_queue):
+    import get_connected
 
-    prefs = underwood_listener.load_preferences()
+    prefs = load_preferences()
 
     # Check if we are online
     if not underwood_listener.is_online():
-        # Attempt to reconnect or alert the user
-        get_connected.connect_to_wifi(message_queue)
+        # Print what we knew last, if anything, then let the user reconnect
+        if snapshot_store.has_snapshot():
+            print_offline_agenda(prefs)
+        else:
+            get_connected.connect_to_wifi(message_queue)
     else:
 
-        credentials = None
-        if os.path.exists('/home/underwood/token.pickle'):
-            with open('/home/underwood/token.pickle', 'rb') as token:
-                credentials = pickle.load(token)
-        if not credentials or not credentials.valid:
-            if credentials and credentials.expired and credentials.refresh_token:
-                credentials.refresh(Request())
-                # Save the refreshed credentials
-                with open('/home/underwood/token.pickle', 'wb') as token:
-                    pickle.dump(credentials, token)
-            else:
-                credentials = get_connected.get_credentials(message_queue)
+        # A fresh prefetched agenda can start typing right away
+        if print_prefetched_agenda(message_queue):
+            return
+
+        credentials = load_credentials(message_queue)
+        sources = collect_sources(credentials)
+
+        # Nothing has changed since an agenda written recently, so print that again
+        cache_key = agenda_cache_key(prefs, sources)
+        cached = load_cached_agenda(cache_key, prefs.get('agenda_cache_minutes', AGENDA_CACHE_MINUTES))
+        if cached is not None:
+            print("Printing a cached agenda; none of its sources have changed.")
+            underwood_listener.send_text(cached, wait=False)
+            return
+
+        messages = build_messages(prefs, sources)
             
-        service = build('gmail', 'v1', credentials=credentials)
-        
-        # Fetch emails from the past 24 hours
-        yesterday = datetime.now() - timedelta(days=1)
-        query = f'label:inbox after:{yesterday.strftime("%Y/%m/%d")} before:{datetime.now().strftime("%Y/%m/%d")}'
-        results = service.users().messages().list(userId='me', q=query).execute()
-        messages = results.get('messages', [])
-        
-        emails = []
-        for message in messages:
-            msg = service.users().messages().get(userId='me', id=message['id'], format='metadata').execute()
-            headers = msg['payload']['headers']
-            subject = next(header['value'] for header in headers if header['name'] == 'Subject')
-            sender = next((header['value'] for header in headers if header['name'] == 'From'), 'Unknown Sender')
-            date_str = next((header['value'] for header in headers if header['name'] == 'Date'), None)
-        
-            if date_str:
-                # Parse the date string and convert it to local timezone
-                date_received = parser.parse(date_str)
-                local_date = date_received.astimezone(tzlocal())
-                date_display = local_date.strftime("%A, %d %B %Y %H:%M:%S %Z")
-            else:
-                date_display = 'No Date'
-            snippet = msg.get('snippet', '')
-            emails.append(f"Sender: {sender}, Subject: {subject}, Date Received: {date_display}, Preview: {snippet}")
-        
-        # Build the Calendar service
-        calendar_service = build('calendar', 'v3', credentials=credentials)
-        
-        # Calendar functionality to fetch events for the next 7 days
-        start_time = datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
-        end_time = (datetime.utcnow() + timedelta(days=7)).isoformat() + 'Z'
-        
-        # Function to fetch events
-        def fetch_events(calendar_id):
-            events_result = calendar_service.events().list(
-                calendarId=calendar_id,
-                timeMin=start_time,
-                timeMax=end_time,
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute()
-            return events_result.get('items', [])
-        
-        # Fetch events from the primary calendar
-        primary_events = fetch_events('primary')
+        # Initialize the completion backend (OpenAI unless the prefs say otherwise)
+        backend = llm_backend.get_backend(prefs)
         
-        # Fetch events from the additional calendar
-        additional_calendar_id = '6lqpbv8647igscie1ictda2c57nigmcn@import.calendar.google.com' # public US holidays & observances
-        birthday_calendar_id = 'addressbook#contacts@group.v.calendar.google.com' # public US holidays & observances
-        additional_events = fetch_events(additional_calendar_id)
-        birthdays = fetch_events(birthday_calendar_id)
-        
-        # Combine events from all calendars
-        all_events = primary_events + additional_events + birthdays
-        
-        cal_list = []
-        
-        for event in all_events:
-            start = event['start'].get('dateTime', event['start'].get('date'))
-            cal_list.append(f"Event: {event['summary']}, Start: {start}")
-            
-        if prefs['fname']:
-            name_prompt = f"I'm {prefs['fname']}. "
+        # Ask for the agenda
+        if prefs.get('stream_agenda', True):
+            # Start typing as soon as the first line is ready
+            with timed("gpt"):
+                text = stream_to_typewriter(backend.stream(messages))
         else:
-            name_prompt = "" 
-        
-        # Get today's date
-        today = datetime.now().strftime("%A, %B %d, %Y, and it's around %-I %p")
-        
-        email_details = "\n".join(emails)  # Assuming `emails` contains the list of email details
-        cal_details = "\n".join(cal_list)
-        
-        # Get local weather & news highlights
-        forecast_str = get_forecast()
-        news_str = get_local_news()
-        
-        user_message = f"Today is {today}. {name_prompt}You're my executive assistant Mr. Underwood. You're a little quirky and goofy. Write me a quick, concise, chipper, friendly note updating me on my agenda. Don't offer any follow-up help. Avoid using non-ASCII characters. Include the date. Be concise - time is money - but include a motivational quote. Mention any important emails from the below list (ignore promotional emails, and focus on things I need to deal with), identify any upcoming holidays, mention any upcoming events from my calendar, and weave in any relevant highlights from the forecast and or/local news, if they seem important and worthy of my busy schedule, from any provided below (ignore any blank sections):\n\nEMAILS:\n\n{email_details}\n\nCALENDAR EVENTS:\n\n{cal_details}\n\n WEATHER:\n{forecast_str}\n\n {prefs['city'].upper()} NEWS:\n{news_str}"
-            
-        # Initialize the OpenAI client
-        client = OpenAI(
-            api_key = os.getenv('OPENAI_API_KEY')
-        )
-        
-        # Prepare the chat messages
-        messages = [
-            {"role": "system", "content": "You are my helpful executive assistant."},
-            {"role": "user", "content": user_message}
-        ]
-        
-        # Send request to OpenAI API using chat completions
-        response = client.chat.completions.create(
-          model="gpt-4-turbo",  # Use the appropriate model for your use case
-          messages=messages
-        )
+            with timed("gpt"):
+                text = backend.complete(messages)
                 
-        underwood_listener.send_text(custom_translate(response.choices[0].message.content))
+            underwood_listener.send_text(text, wait=False)
+
+        if text:
+            save_cached_agenda(cache_key, text)
+
+def print_offline_agenda(prefs):
+    """Type a plain agenda from the offline snapshot, no LLM required."""
+    try:
+        with timed("offline agenda"):
+            text = snapshot_store.render_offline_agenda(prefs.get('fname'))
+    except (OSError, sqlite3.Error) as e:
+        print(f"Failed to read the offline snapshot: {e}")
+        underwood_listener.send_text("I can't get online right now. Hit the RELOC key if you'd like to set up Wi-Fi.")
+        return
+    underwood_listener.send_text(text, wait=False)
+
+############## AGENDA CACHE ##############
+
+AGENDA_CACHE_PATH = '/home/underwood/agenda_cache.json'
+AGENDA_CACHE_MINUTES = 60  # Default, overridden by the 'agenda_cache_minutes' preference
+AGENDA_CACHE_SIZE = 10  # Most agendas kept
+
+agenda_cache_lock = Lock()
+
+def agenda_cache_key(prefs, sources):
+    """
+    Hash everything the agenda is written from: which emails, events (and their edits),
+    forecast and news stories, who and where it's for, and the hour it's written in.
+    """
+    events = sources['primary_events'] + sources['additional_events'] + sources['birthdays']
+    inputs = {
+        'emails': sorted(msg['id'] for msg in sources['emails']),
+        'events': sorted([event.get('id', ''), event.get('updated', '')] for event in events),
+        'forecast': sources['forecast'],
+        'news': [item.get('url') or item.get('name') for item in sources['news'] or []],
+        'hour': datetime.now().strftime('%Y-%m-%d %H'),
+        'fname': prefs['fname'],
+        'city': prefs['city'],
+        'model': prefs.get('llm_model') or llm_backend.DEFAULT_MODEL
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+def load_agenda_cache():
+    try:
+        with open(AGENDA_CACHE_PATH, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def load_cached_agenda(key, ttl_minutes):
+    """Return the agenda written from the same inputs within the last `ttl_minutes`, or None."""
+    with agenda_cache_lock:
+        entry = load_agenda_cache().get(key)
+    if entry and time.time() - entry['created_at'] < ttl_minutes * 60:
+        return entry['text']
+    return None
+
+def save_cached_agenda(key, text):
+    """Remember an agenda by the hash of its inputs, evicting the oldest beyond AGENDA_CACHE_SIZE."""
+    with agenda_cache_lock:
+        cache = load_agenda_cache()
+        cache[key] = {'text': text, 'created_at': time.time()}
+        newest = sorted(cache.items(), key=lambda item: item[1]['created_at'], reverse=True)[:AGENDA_CACHE_SIZE]
+
+        try:
+            atomic_write_json(AGENDA_CACHE_PATH, dict(newest))
+        except OSError as e:
+            print(f"Error saving agenda cache: {e}")
+
+############## PREFETCH ##############
+
+PREFETCH_PATH = '/home/underwood/agenda_prefetch.json'
+PREFETCH_FRESHNESS = 45 * 60  # How long after its sources were fetched a prefetched agenda may be printed
+PREFETCH_WAIT = 120  # How long a print will wait for a prefetch that's still running
+
+prefetch_lock = Lock()
+
+def prefetch_agenda():
+    """Collect every source and write the agenda ahead of its scheduled print time."""
+    with prefetch_lock:
+        if not underwood_listener.is_online():
+            print("Offline, skipping the agenda prefetch.")
+            return False
+
+        credentials = load_credentials(None)
+        if credentials is None:
+            print("No usable Google credentials, skipping the agenda prefetch.")
+            return False
+
+        fetched_at = time.time()
+        prefs = load_preferences()
+        sources = collect_sources(credentials)
+        messages = build_messages(prefs, sources)
+
+        with timed("gpt (prefetch)"):
+            text = llm_backend.get_backend(prefs).complete(messages)
+
+        try:
+            atomic_write_json(PREFETCH_PATH, {'text': text, 'fetched_at': fetched_at})
+        except OSError as e:
+            print(f"Error saving prefetched agenda: {e}")
+        save_cached_agenda(agenda_cache_key(prefs, sources), text)
+        return True
+
+def take_prefetched_agenda():
+    """Return the prefetched agenda if it's still fresh, removing it so it's only printed once."""
+    # Wait for a prefetch that's still running rather than starting from scratch
+    if not prefetch_lock.acquire(timeout=PREFETCH_WAIT):
+        return None
+    try:
+        with open(PREFETCH_PATH, 'r') as file:
+            prefetched = json.load(file)
+        os.remove(PREFETCH_PATH)
+    except (OSError, ValueError):
+        return None
+    finally:
+        prefetch_lock.release()
+
+    if time.time() - prefetched.get('fetched_at', 0) > PREFETCH_FRESHNESS:
+        return None
+    return prefetched
+
+def print_prefetched_agenda(message_queue):
+    """Type the prefetched agenda, then add any mail that arrived since it was written."""
+    prefetched = take_prefetched_agenda()
+    if prefetched is None:
+        return False
+
+    underwood_listener.send_text(prefetched['text'], wait=False)
+
+    # The incremental refresh happens while the agenda is typing
+    try:
+        credentials = load_credentials(message_queue)
+        with timed("gmail (since prefetch)"):
+            new_emails = fetch_new_emails(google_services.get_service('gmail', 'v1', credentials), prefetched['fetched_at'])
+        if new_emails:
+            underwood_listener.send_text("P.S. Since I wrote this, these emails came in:\n" + "\n".join(new_emails), wait=False)
+    except Exception as e:
+        print(f"Error checking for new emails: {e}")
+    return True
 
 ############## LAUNCHER ##############
 
-def main():
+def run_locally():
+    """Generate the agenda in this process, for when the listener daemon isn't running."""
+    # Read the firmware's ACKs so output is paced on them
+    Thread(target=underwood_listener.receive_typed_text, daemon=True).start()
     generate_agenda(underwood_listener.message_queue)
+    # Let the output engine finish typing before the process exits
+    with timed("typing"):
+        underwood_listener.connect().wait()
+
+def main():
+    # Hand the agenda to the warm listener daemon, which already holds the serial port
+    try:
+        response = control_socket.send_command('agenda')
+        print(f"Agenda requested from the listener: {response}")
+    except OSError:
+        run_locally()
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,90 +3,56 @@
 ############## EXTERNAL FUNCTIONS ##############
 
 import underwood_listener
-from schedule_agenda import schedule_agenda
+import typewriter
+import http_client
+import google_services
+import google_credentials
+import wpa_ctrl
+import wifi_scanner
+import connectivity
+from preferences import load_preferences, update_preferences, atomic_write_json
 
 ############## DEPENDENCIES ##############
 
+# Heavy libraries (googleapiclient, google_auth_oauthlib, requests) are imported
+# where they're first used.
+
 #SYS
 
-from datetime import datetime, timedelta
-import pytz
+from datetime import datetime
 import time
 import os
-import sys
 import subprocess
-from queue import Queue, Empty
+from queue import Empty
 from dotenv import load_dotenv
 load_dotenv()
-import pytz
-from tzlocal import get_localzone, get_localzone_name
+from tzlocal import get_localzone_name
 from zoneinfo import ZoneInfo
 import threading
 
 #API
 
-import re
-import requests
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 import socketserver
 from urllib.parse import urlparse, parse_qs
-import pickle
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from openai import OpenAI
-
-#TXT
-
 import json
 
-def load_preferences():
-    """Load preferences from a JSON file, create the file with default settings if it does not exist."""
-    prefs_path = '/home/underwood/prefs.json'
-
-    default_prefs = {
-        'first_boot': True,
-        'lat': None,
-        'lng': None,
-        'fname': None,
-        'lname': None,
-        'city': None,
-        'state': None
-    }
-
-    if os.path.exists(prefs_path):
-        # Check if the file is blank
-        if os.path.getsize(prefs_path) == 0:
-            # Write default preferences to the file if it is blank
-            with open(prefs_path, 'w') as file:
-                json.dump(default_prefs, file, indent=4)
-            return default_prefs
-        else:
-            # Load and return preferences if the file exists and is not blank
-            with open(prefs_path, 'r') as file:
-                return json.load(file)
-    else:
-        # Create the prefs.json file with default preferences if it does not exist
-        with open(prefs_path, 'w') as file:
-            json.dump(default_prefs, file, indent=4)
-        return default_prefs
-
-def save_preferences(preferences):
-    """Save preferences to the JSON file."""
-    with open('/home/underwood/prefs.json', 'w') as file:
-        json.dump(preferences, file, indent=4)
-
 def get_location_from_google(wifi_networks):
     """
     Send Wi-Fi networks data to Google's Geolocation API to determine the device's location.
     """
+    import requests
+
     url = "https://www.googleapis.com/geolocation/v1/geolocate"
     headers = {"Content-Type": "application/json"}
     params = {"key": os.getenv('GOOGLE_API_KEY')}
     data = {"wifiAccessPoints": wifi_networks}
 
-    response = requests.post(url, headers=headers, params=params, json=data)
+    try:
+        response = http_client.post(url, headers=headers, params=params, json=data)
+    except requests.RequestException as e:
+        print(f"Error: {e}")
+        return f"Error: {e}"
     if response.status_code == 200:
         return response.json()
     else:
@@ -97,8 +63,14 @@ def get_location_name(lat, lng):
     """
     Use Google Maps Geocoding API to convert latitude and longitude to location name.
     """
+    import requests
+
     geocode_url = f"https://maps.googleapis.com/maps/api/geocode/json?latlng={lat},{lng}&key={os.getenv('GOOGLE_API_KEY')}"
-    response = requests.get(geocode_url)
+    try:
+        response = http_client.get(geocode_url)
+    except requests.RequestException as e:
+        print(f"Error: {e}")
+        return None, None
     if response.status_code == 200:
         results = response.json().get('results', [])
         if results:
@@ -119,6 +91,72 @@ def get_location_name(lat, lng):
     else:
         return None, None
 
+############## LOCATION CACHE ##############
+
+LOCATION_CACHE_PATH = '/home/underwood/location_cache.json'
+LOCATION_TTL = 30 * 24 * 60 * 60  # Re-check a cached location after 30 days, in seconds
+FINGERPRINT_SIZE = 8  # How many of the strongest access points identify a place
+MATCH_THRESHOLD = 0.5  # Minimum Jaccard overlap between fingerprints to reuse a location
+MAX_LOCATIONS = 20
+
+def location_fingerprint(wifi_networks):
+    """Identify a place by the BSSIDs of its strongest access points."""
+    strongest = sorted(wifi_networks, key=lambda network: network['signalStrength'], reverse=True)
+    return {network['macAddress'].lower() for network in strongest[:FINGERPRINT_SIZE]}
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a | b else 0
+
+def load_location_cache():
+    """Load the unexpired cached locations."""
+    try:
+        with open(LOCATION_CACHE_PATH, 'r') as file:
+            entries = json.load(file)
+    except (OSError, ValueError):
+        return []
+    return [entry for entry in entries if time.time() - entry.get('cached_at', 0) < LOCATION_TTL]
+
+def save_location_cache(entries):
+    """Write the location cache atomically, keeping only the most recent locations."""
+    try:
+        atomic_write_json(LOCATION_CACHE_PATH, entries[-MAX_LOCATIONS:])
+    except OSError as e:
+        print(f"Error saving location cache: {e}")
+
+def locate(wifi_networks):
+    """
+    Return (lat, lng, city, state) for the access points in range, from the cache if
+    they mostly match a place seen before, or from the Geolocation and Geocoding APIs.
+    Returns None if the location can't be found.
+    """
+    fingerprint = location_fingerprint(wifi_networks)
+    entries = load_location_cache()
+
+    if fingerprint:
+        best = max(entries, key=lambda entry: jaccard(fingerprint, set(entry['bssids'])), default=None)
+        if best is not None and jaccard(fingerprint, set(best['bssids'])) >= MATCH_THRESHOLD:
+            return best['lat'], best['lng'], best['city'], best['state']
+
+    location_response = get_location_from_google(wifi_networks)
+    if not isinstance(location_response, dict) or 'location' not in location_response:
+        return None
+
+    lat = location_response['location']['lat']
+    lng = location_response['location']['lng']
+    city, state = get_location_name(lat, lng)
+
+    if fingerprint and city:
+        entries.append({
+            'bssids': sorted(fingerprint),
+            'lat': lat,
+            'lng': lng,
+            'city': city,
+            'state': state,
+            'cached_at': time.time()
+        })
+        save_location_cache(entries)
+    return lat, lng, city, state
+
 def get_time_of_day(tz):
             
     # Get the current system time
@@ -147,81 +185,87 @@ def remove_last_network_block():
         with open('/etc/wpa_supplicant/wpa_supplicant.conf', 'w') as file:
             file.writelines(lines[:start_line])
 
-def scan_wifi(interface='wlan0'):
-    """
-    Scan for Wi-Fi networks using wpa_cli and extract MAC addresses, signal strengths, and SSIDs.
-    """
-    wifi_networks = []
-    try:
-        # Trigger a new scan
-        subprocess.run(['sudo', 'wpa_cli', '-i', interface, 'scan'], check=True)
-
-        # Give a little time for scan to complete, this may need to be adjusted
-        time.sleep(3)
-
-        # Fetch the scan results
-        scan_output = subprocess.check_output(['sudo', 'wpa_cli', '-i', interface, 'scan_results']).decode('utf-8')
-
-        # Parse the scan results
-        for line in scan_output.split('\n'):
-            parts = line.split()
-            if len(parts) >= 5 and parts[0] not in ('bssid', 'BSSID'):
-                mac_address = parts[0]
-                signal_strength = parts[2]
-                ssid = ' '.join(parts[4:])  # SSID can contain spaces
-                wifi_networks.append({
-                    "macAddress": mac_address,
-                    "signalStrength": int(signal_strength),
-                    "ssid": ssid
-                })
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to scan for Wi-Fi networks: {e}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-    return wifi_networks
+ASSOCIATION_TIMEOUT = 30  # seconds
+ONLINE_TIMEOUT = 20  # seconds from associating to being online (DHCP and so on)
+
+def find_ssid(typed):
+    """Return the visible network `typed` most likely names, rescanning once if it isn't there yet."""
+    ssid = wifi_scanner.scanner.find(typed)
+    if ssid is None and wifi_scanner.scanner.rescan():
+        ssid = wifi_scanner.scanner.find(typed)
+    return ssid
 
 def configure_wifi(ssid, password):
-    """Configure the Wi-Fi connection using wpa_cli, setting the network with the highest priority."""
+    """
+    Configure the Wi-Fi connection over wpa_supplicant's control socket, setting the network with the highest priority.
+    Returns the network ID (or None if it couldn't be set up) and whether the device then connected to it.
+    """
     
-    underwood_listener.send_text("Okay! Give me a few moments, I'm going to try to connect. This may take up to 20 seconds.")
+    underwood_listener.send_text(f"Okay! Give me a few moments, I'm going to try to connect. This may take up to {ASSOCIATION_TIMEOUT + ONLINE_TIMEOUT} seconds.")
 
+    network_id = None
     try:
-        # Add a new network and get its network ID
-        add_network_output = subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'add_network'], capture_output=True, text=True)
-        network_id = add_network_output.stdout.strip().splitlines()[-1]  # Last line should be the network id
-
-        # Set network SSID and PSK
-        subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'set_network', network_id, 'ssid', f'"{ssid}"'], check=True)
-        subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'set_network', network_id, 'psk', f'"{password}"'], check=True)
-
-        # Determine the highest priority of existing networks
-        list_output = subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'list_networks'], capture_output=True, text=True)
-        max_priority = 0
-        for line in list_output.stdout.splitlines()[1:]:  # Skip the first line (header)
-            fields = line.split()
-            if len(fields) >= 4:  # Ensure there are enough fields
-                current_priority_output = subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'get_network', fields[0], 'priority'], capture_output=True, text=True)
-                current_priority = int(current_priority_output.stdout.strip())
-                if current_priority > max_priority:
-                    max_priority = current_priority
-
-        # Set priority of the new network higher than the highest found
-        new_priority = max_priority + 1
-        subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'set_network', network_id, 'priority', str(new_priority)], check=True)
-
-        subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'enable_network', network_id], check=True)
-
-        # Save the configuration to ensure it persists
-        subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'save_config'], check=True)
-
-        # Use reassociate to connect to the best available network
-        subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'reconfigure'], check=True)
-
-        return network_id  # Return the network ID for further management
-    except subprocess.CalledProcessError as e:
+        with wpa_ctrl.WpaCtrl() as wpa:
+            # Add a new network and get its network ID
+            network_id = wpa.add_network()
+
+            # Set network SSID (hex-encoded, so any characters survive) and PSK
+            wpa.set_network(network_id, 'ssid', wpa_ctrl.hex_ssid(ssid))
+            wpa.set_network(network_id, 'psk', f'"{password}"')
+
+            # Determine the highest priority of existing networks
+            max_priority = 0
+            for network in wpa.list_networks():
+                max_priority = max(max_priority, int(wpa.get_network(network['id'], 'priority') or 0))
+
+            # Set priority of the new network higher than the highest found
+            wpa.set_network(network_id, 'priority', str(max_priority + 1))
+            wpa.enable_network(network_id)
+
+            # Save the configuration to ensure it persists
+            wpa.save_config()
+
+            # Use reassociate to connect to the best available network, listening for how it goes
+            wpa.attach()
+            wpa.reconfigure()
+            connected = wait_for_association(wpa, network_id, ssid)
+
+        return network_id, connected  # Return the network ID for further management
+    except (OSError, ValueError, wpa_ctrl.WpaCtrlError) as e:
         print(f"Failed to configure Wi-Fi: {e}")
-        return None
+        # Don't leave a half-configured network behind in wpa_supplicant
+        if network_id is not None:
+            forget_network(network_id)
+        return None, False
+
+def wait_for_association(wpa, network_id, ssid, timeout=ASSOCIATION_TIMEOUT):
+    """Wait until wpa_supplicant connects to `ssid`, or gives up on network `network_id` (e.g. a wrong password)."""
+    deadline = time.monotonic() + timeout
+    while True:
+        event = wpa.wait_event(['CTRL-EVENT-CONNECTED', 'CTRL-EVENT-SSID-TEMP-DISABLED'], deadline - time.monotonic())
+        if event is None:
+            print(f"Didn't connect to {ssid} within {timeout}s")
+            return False
+        if event.startswith('CTRL-EVENT-SSID-TEMP-DISABLED'):
+            # Other saved networks failing in the background don't mean ours has
+            if f'id={network_id}' in event.split():
+                print(f"Couldn't connect: {event}")
+                return False
+            continue
+        # It may have picked another saved network, so check which one
+        if wpa.status().get('ssid') == ssid:
+            return True
+
+def forget_network(network_id):
+    """Remove a network that couldn't connect, and go back to the saved ones."""
+    try:
+        with wpa_ctrl.WpaCtrl() as wpa:
+            wpa.remove_network(network_id)
+            wpa.save_config()
+            wpa.enable_network('all')
+            wpa.reconfigure()
+    except (OSError, wpa_ctrl.WpaCtrlError) as e:
+        print(f"Failed to remove network {network_id}: {e}")
 
 def connect_to_wifi(message_queue):
 
@@ -232,13 +276,11 @@ def connect_to_wifi(message_queue):
     time_of_day = get_time_of_day(tz)
     greeting_shown = False
         
-    wifi_networks = scan_wifi()
+    # Scan in the background while the prompts are typing
+    wifi_scanner.scanner.start()
         
     prefs = load_preferences()
     
-    if wifi_networks:                
-        available_ssids = [network['ssid'] for network in wifi_networks]
-    
     while True:
 
         if (prefs['first_boot'] == True):
@@ -253,58 +295,51 @@ def connect_to_wifi(message_queue):
         underwood_listener.send_text("Please type in your (2.4GHz) Wi-Fi network name (and then hit the RETURN key): ")
         
         try:
-            raw_data = message_queue.get(timeout=60)
-            if raw_data:
-                if b'\x7f' in raw_data:  # Check for character 127 (DEL)
+            event = message_queue.get(timeout=60)
+            if event:
+                if event.kind == typewriter.CANCEL:  # BACKSPACE
                     print("delete")
                     #return
                 else:
-                    ssid = raw_data.decode('utf-8').strip()
+                    typed_ssid = event.text
+                    ssid = find_ssid(typed_ssid)
     
-                    if ssid not in available_ssids:
-                        underwood_listener.send_text(f"I'm so sorry, but I couldn't find a network named '{ssid}'. Would you mind trying that again? ")
+                    if ssid is None:
+                        underwood_listener.send_text(f"I'm so sorry, but I couldn't find a network named '{typed_ssid}'. Would you mind trying that again? ")
                         continue
+                    if ssid != typed_ssid:
+                        underwood_listener.send_text(f"I couldn't find '{typed_ssid}', so I'm guessing you meant '{ssid}'.")
                 
                     underwood_listener.send_text(f"Great! Now, what's the password for '{ssid}'? ")
                     while True:
                     
                         try:
-                            raw_data = message_queue.get(timeout=60)                     
-                            password = raw_data.decode('utf-8').strip()
+                            event = message_queue.get(timeout=60)
+                            password = event.text
                             
-                            network_id = configure_wifi(ssid, password)
-                            #print(str(subprocess.check_output("iwgetid -r", shell = True)))
+                            network_id, connected = configure_wifi(ssid, password)
                             if network_id is not None:
-                                time.sleep(20)  # Wait for connection to establish
-                                if ssid in str(subprocess.check_output("iwgetid -r", shell = True)) and underwood_listener.is_online():
+                                # Connected to the network; now wait for an address and a route out
+                                if connected and connectivity.monitor.wait_for(True, timeout=ONLINE_TIMEOUT):
                                     underwood_listener.send_text(f"Good news! I've successfully connected to {ssid}.")
                                     
-                                    location_response = get_location_from_google(wifi_networks)
-                                    if 'location' in location_response:
-                                        prefs['lat'] = location_response['location']['lat']
-                                        prefs['lng'] = location_response['location']['lng']
-                                        city, state = get_location_name(prefs['lat'], prefs['lng'])
-                                        prefs['city'] = city if city else 'Chicago'
-                                        prefs['state'] = state if state else 'Illinois'
-                                        save_preferences(prefs)
+                                    location = locate(wifi_scanner.scanner.wifi_networks())
+                                    if location:
+                                        lat, lng, city, state = location
+                                        prefs = update_preferences(lat=lat, lng=lng, city=city if city else 'Chicago', state=state if state else 'Illinois')
                                     else:
                                         print("Missing location data")
 
                                     get_credentials(message_queue)
                                     
-                                    prefs = load_preferences()
-                                    prefs['first_boot'] = False
-                                    save_preferences(prefs)
+                                    prefs = update_preferences(first_boot=False)
  
                                     return  # Exit the password loop on successful connection
                                 else:
                                     print(password)
                                     underwood_listener.send_text(f"I'm so sorry, but I wasn't able to connect to '{ssid}'. Would you mind checking your password and trying again? ")
                                     # Remove the network if connection fails
-                                    subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'remove_network', network_id], check=True)
-                                    subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'save_config'], check=True)
-                                    subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'enable_network', 'all'], check=True)
-                                    subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'reconfigure'], check=True)
+                                    forget_network(network_id)
                                     # Instead of breaking, it loops back to ask for the password again without repeating the "Great! Now, what's the password?" line.
                             else:
                                 underwood_listener.send_text(f"I'm so sorry, but I wasn't able to connect to '{ssid}'. Please try again.")
@@ -398,70 +433,63 @@ class CallbackHandler(BaseHTTPRequestHandler):
                 self.wfile.write(response_html.encode('utf-8'))
 
 def get_credentials(message_queue):
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from schedule_agenda import schedule_agenda
+
     global oauth_url
-    credentials = None
     
 #     credential_path = "/home/underwood/underwood-417620-d00783028138.json"
 #     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credential_path
     
-    if os.path.exists('/home/underwood/token.pickle'):
-        with open('/home/underwood/token.pickle', 'rb') as token:
-            credentials = pickle.load(token)
-    if not credentials or not credentials.valid:
-        if credentials and credentials.expired and credentials.refresh_token:
-            credentials.refresh(Request())
-            # Save the refreshed credentials
-            with open('token.pickle', 'wb') as token:
-                pickle.dump(credentials, token)
-        else:
-            # Start a simple HTTP server to handle the redirect
-            port = 8080
-            handler = CallbackHandler
-            httpd = socketserver.TCPServer(("", port), handler)
-            # print(f"Local server is running on port {port}")
-
-            # Start Cloudflare tunnel using subprocess
-            cloudflared_process = subprocess.Popen(['sudo', '-u' ,'underwood', 'cloudflared', 'tunnel', 'run', '--url', 'localhost:8080', '9dacf679-da50-4323-9ce2-bf7388380d6c'])
-            # print("Cloudflare tunnel started")
-
-            # Assuming your Cloudflare tunnel points to localhost:8080
-            redirect_uri = 'https://login.underwood.today/oauth2callback'
-            # print(f"Redirect URI: {redirect_uri}")
-            flow = InstalledAppFlow.from_client_secrets_file('/home/underwood/client_secret.json', SCOPES, redirect_uri=redirect_uri)
-
-            oauth_url, _ = flow.authorization_url(access_type='offline', prompt='consent')
-            
-            # Create a thread that runs my_function
-            auth_instruct_thread = threading.Thread(target=auth_instructions)
-            
-            # Start the thread
-            auth_instruct_thread.start()
-            
-            timeout = 120  # Timeout in seconds (e.g., 2 minutes)
-            start_time = time.time()
+    credentials = google_credentials.manager.get()
+    if credentials is None:
+        # Start a simple HTTP server to handle the redirect
+        port = 8080
+        handler = CallbackHandler
+        httpd = socketserver.TCPServer(("", port), handler)
+        # print(f"Local server is running on port {port}")
+
+        # Start Cloudflare tunnel using subprocess
+        cloudflared_process = subprocess.Popen(['sudo', '-u' ,'underwood', 'cloudflared', 'tunnel', 'run', '--url', 'localhost:8080', '9dacf679-da50-4323-9ce2-bf7388380d6c'])
+        # print("Cloudflare tunnel started")
+
+        # Assuming your Cloudflare tunnel points to localhost:8080
+        redirect_uri = 'https://login.underwood.today/oauth2callback'
+        # print(f"Redirect URI: {redirect_uri}")
+        flow = InstalledAppFlow.from_client_secrets_file('/home/underwood/client_secret.json', SCOPES, redirect_uri=redirect_uri)
+
+        oauth_url, _ = flow.authorization_url(access_type='offline', prompt='consent')
+        
+        # Create a thread that runs my_function
+        auth_instruct_thread = threading.Thread(target=auth_instructions)
+        
+        # Start the thread
+        auth_instruct_thread.start()
+        
+        timeout = 120  # Timeout in seconds (e.g., 2 minutes)
+        start_time = time.time()
 
-            try:
-                while CallbackHandler.authorization_code is None and not CallbackHandler.error_message:
-                    httpd.handle_request()
-                    
-                    if time.time() - start_time > timeout:
-                        underwood_listener.send_text("Oh dear, our session has timed out. Would you mind trying again?")
-                        start_time = time.time()  # Reset timer and allow for another attempt
-            finally:
-                httpd.server_close()
-                cloudflared_process.terminate()
-                auth_instruct_thread.join()
-                # print("HTTP server and tunnel closed.")
-    
-            if CallbackHandler.authorization_code:
-                flow.fetch_token(code=CallbackHandler.authorization_code)
-                credentials = flow.credentials
-                with open('token.pickle', 'wb') as token:
-                    pickle.dump(credentials, token)
-                set_name(credentials)
-                underwood_listener.send_text("Hooray! You've successfully connected your Google account.")
-                underwood_listener.send_text("You can hit the EXPR key at any time to get your agenda, or hit the RELOC key for settings.")        
-                schedule_agenda(message_queue)
+        try:
+            while CallbackHandler.authorization_code is None and not CallbackHandler.error_message:
+                httpd.handle_request()
+                
+                if time.time() - start_time > timeout:
+                    underwood_listener.send_text("Oh dear, our session has timed out. Would you mind trying again?")
+                    start_time = time.time()  # Reset timer and allow for another attempt
+        finally:
+            httpd.server_close()
+            cloudflared_process.terminate()
+            auth_instruct_thread.join()
+            # print("HTTP server and tunnel closed.")
+
+        if CallbackHandler.authorization_code:
+            flow.fetch_token(code=CallbackHandler.authorization_code)
+            credentials = flow.credentials
+            google_credentials.manager.set(credentials)
+            set_name(credentials)
+            underwood_listener.send_text("Hooray! You've successfully connected your Google account.")
+            underwood_listener.send_text("You can hit the EXPR key at any time to get your agenda, or hit the RELOC key for settings.")        
+            schedule_agenda(message_queue)
 
     return credentials
 
@@ -476,11 +504,8 @@ def auth_instructions():
         underwood_listener.send_text("(Note: while this app is awaiting Google approval, you may see a message that says 'Google hasn't verified this app.' You'll need to tap 'Advanced,' then 'Go to underwood.today (unsafe),' then select each checkbox and hit 'Continue.' Spoiler alert: it's not unsafe, just pending review. I apologize for the extra steps!)")
 
 def set_name(credentials):
-
-    prefs = load_preferences()
-
     #Build the people service
-    people_service = build('people', 'v1', credentials=credentials, cache_discovery=False)
+    people_service = google_services.get_service('people', 'v1', credentials)
     
     # Request to get the user's names
     results = people_service.people().get(resourceName='people/me', personFields='names').execute()
@@ -488,9 +513,7 @@ def set_name(credentials):
     
     if names:
         name = names[0]  # Assuming the first name object is the primary name
-        prefs['fname'] = name.get('givenName', 'Andrew')
-        prefs['lname'] = name.get('familyName')
-        save_preferences(prefs)
+        update_preferences(fname=name.get('givenName', 'Andrew'), lname=name.get('familyName'))
         
         
 ############## LAUNCHER ##############
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+The Google OAuth credentials, held in memory by one CredentialManager per process.
+
+The access token is refreshed on a background timer a few minutes before it expires,
+so agenda runs pick up valid credentials without waiting on Google. Every change is
+written atomically to the one token.pickle everything else reads.
+"""
+
+############## DEPENDENCIES ##############
+
+# google.auth is imported where it's first used
+
+import os
+import copy
+import pickle
+from datetime import datetime
+from threading import Lock, Timer
+
+from preferences import atomic_write
+
+############## CREDENTIALS ##############
+
+TOKEN_PATH = '/home/underwood/token.pickle'
+REFRESH_MARGIN = 5 * 60  # Refresh this many seconds before the token expires
+RETRY_DELAY = 60  # Wait this long to try again after a failed refresh (e.g. while offline)
+
+class CredentialManager:
+
+    def __init__(self, path=TOKEN_PATH):
+        self.path = path
+        self.credentials = None
+        self.loaded = False
+        self.timer = None
+        self.lock = Lock()
+
+    def get(self):
+        """
+        Return the current credentials, or None if the user needs to sign in. They're
+        normally already fresh; a refresh only happens here if the background one
+        couldn't run in time.
+        """
+        with self.lock:
+            if not self.loaded:
+                self.credentials = self.load()
+                self.loaded = True
+                self.schedule_refresh()
+            credentials = self.credentials
+
+        if credentials is None:
+            return None
+        if not credentials.valid:
+            if not credentials.refresh_token:
+                return None
+            self.refresh(credentials)
+            with self.lock:
+                return self.credentials
+        return credentials
+
+    def set(self, credentials):
+        """Use newly authorized credentials from here on."""
+        with self.lock:
+            self.credentials = credentials
+            self.loaded = True
+            self.persist()
+            self.schedule_refresh()
+
+    def forget(self):
+        """Drop the credentials and delete token.pickle, e.g. when the system is reset."""
+        with self.lock:
+            self.cancel_timer()
+            self.credentials = None
+            self.loaded = False
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def load(self):
+        """Read token.pickle, or return None if there isn't a usable one."""
+        try:
+            with open(self.path, 'rb') as token:
+                return pickle.load(token)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error reading {self.path}: {e}")
+            return None
+
+    def persist(self):
+        """Write the credentials atomically over token.pickle (holding `lock`)."""
+        atomic_write(self.path, pickle.dumps(self.credentials))
+
+    def refresh(self, credentials):
+        """
+        Refresh a copy of `credentials` without holding `lock`, so get() never waits on
+        Google, then swap it in unless the credentials were replaced in the meantime.
+        Returns whether the refreshed copy was swapped in.
+        """
+        from google.auth.transport.requests import Request
+        from google.auth.exceptions import RefreshError
+
+        fresh = copy.copy(credentials)
+        try:
+            fresh.refresh(Request())
+        except RefreshError as e:
+            # The grant was revoked or has expired, so the user has to sign in again
+            print(f"Google refused to refresh the credentials: {e}")
+            fresh = None
+        except Exception as e:
+            print(f"Error refreshing the Google credentials: {e}")
+            return False
+
+        with self.lock:
+            if self.credentials is not credentials:
+                return False  # Signed in again, or forgotten, while refreshing
+            self.credentials = fresh
+            if fresh is None:
+                return False
+            self.persist()
+            return True
+
+    def schedule_refresh(self, delay=None):
+        """Start the timer for the next background refresh (holding `lock`)."""
+        self.cancel_timer()
+        credentials = self.credentials
+        if credentials is None or not credentials.refresh_token:
+            return
+
+        if delay is None:
+            if credentials.expiry is None:
+                return
+            # google-auth keeps expiry as a naive UTC datetime
+            delay = (credentials.expiry - datetime.utcnow()).total_seconds() - REFRESH_MARGIN
+
+        self.timer = Timer(max(0, delay), self.background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def background_refresh(self):
+        with self.lock:
+            credentials = self.credentials
+        if credentials is None:
+            return
+
+        refreshed = self.refresh(credentials)
+        with self.lock:
+            if refreshed:
+                self.schedule_refresh()
+            elif self.credentials is credentials:
+                self.schedule_refresh(RETRY_DELAY)
+
+manager = CredentialManager()
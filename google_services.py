@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+Built Google API clients (Gmail, Calendar, People), kept for the life of the process.
+
+build() parses a large discovery document (bundled with google-api-python-client, so
+it's already on disk), so each client is built once and reused. Clients are only rebuilt
+when the credentials belong to a different grant (i.e. the user signed in again);
+refreshed tokens are picked up by the existing clients.
+
+httplib2 connections aren't thread-safe, so every request is made on an authorized
+connection belonging to the calling thread rather than on the shared client's.
+"""
+
+############## DEPENDENCIES ##############
+
+# googleapiclient and google_auth_httplib2 are imported where they're first used
+
+import threading
+
+############## SERVICES ##############
+
+_services = {}  # (api, version) -> built client
+_credentials = None
+_account = None
+_lock = threading.Lock()
+_local = threading.local()
+
+def account_key(credentials):
+    """Identify the grant behind some credentials; it stays the same when the access token is refreshed."""
+    return (getattr(credentials, 'client_id', None), getattr(credentials, 'refresh_token', None))
+
+def thread_http():
+    """Return this thread's authorized connection, making a new one if the credentials have changed."""
+    import google_auth_httplib2
+    from googleapiclient.http import build_http
+
+    credentials = _credentials
+    if getattr(_local, 'credentials', None) is not credentials:
+        # build_http() sets the library's default socket timeout, so a stalled request can't hang its thread
+        _local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=build_http())
+        _local.credentials = credentials
+    return _local.http
+
+def build_request(http, *args, **kwargs):
+    """requestBuilder for built clients: ignore the client's shared connection and use this thread's own."""
+    from googleapiclient.http import HttpRequest
+
+    return HttpRequest(thread_http(), *args, **kwargs)
+
+def get_service(api, version, credentials):
+    """Return the client for `api`/`version`, building it the first time or after the user signs in again."""
+    global _credentials, _account
+    from googleapiclient.discovery import build
+
+    with _lock:
+        # Requests always use the newest credentials, but only a different account needs new clients
+        _credentials = credentials
+        if account_key(credentials) != _account:
+            _services.clear()
+            _account = account_key(credentials)
+
+        service = _services.get((api, version))
+        if service is None:
+            service = build(
+                api,
+                version,
+                credentials=credentials,
+                requestBuilder=build_request
+            )
+            _services[(api, version)] = service
+        return service
+
+def forget_services():
+    """Drop every built client, e.g. after the user's Google account is disconnected."""
+    global _credentials, _account
+
+    with _lock:
+        _services.clear()
+        _credentials = None
+        _account = None
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+One shared HTTP session for every REST call (NWS, Bing, Google Maps, OAuth), so
+connections are kept alive and reused instead of paying a DNS lookup, TCP handshake
+and TLS handshake per request. Requests get default timeouts and retry with backoff,
+and the latency of each host is recorded for the status command.
+"""
+
+############## DEPENDENCIES ##############
+
+# requests is imported when the session is first created, to keep startup fast
+
+import time
+from threading import Lock
+from urllib.parse import urlparse
+
+############## SESSION ##############
+
+CONNECT_TIMEOUT = 5  # seconds
+READ_TIMEOUT = 20  # seconds
+RETRIES = 3
+BACKOFF_FACTOR = 0.5  # Retries wait 0.5s, 1s, 2s
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+POOL_SIZE = 10  # The agenda's sources are fetched in parallel
+
+_session = None
+_session_lock = Lock()
+
+def session():
+    """Return the shared requests.Session, creating it on first use."""
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=RETRIES,
+                backoff_factor=BACKOFF_FACTOR,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(['GET', 'POST']),
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session.hooks['response'].append(record_latency)
+        return _session
+
+def request(method, url, **kwargs):
+    """Make a request on the shared session, with the default timeouts unless others are given."""
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return session().request(method, url, **kwargs)
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+############## METRICS ##############
+
+latency = {}  # host -> {'count', 'errors', 'total', 'max'}
+_latency_lock = Lock()
+
+def record_latency(response, *args, **kwargs):
+    """Response hook: add the time until the response headers arrived to its host's stats."""
+    host = urlparse(response.url).hostname
+    seconds = response.elapsed.total_seconds()
+    with _latency_lock:
+        stats = latency.setdefault(host, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0, 'last': None})
+        stats['count'] += 1
+        stats['errors'] += response.status_code >= 400
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+        stats['last'] = time.time()
+
+def latency_report():
+    """Summarise the per-host latency stats, in milliseconds."""
+    with _latency_lock:
+        return {
+            host: {
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'avg_ms': round(stats['total'] / stats['count'] * 1000),
+                'max_ms': round(stats['max'] * 1000)
+            }
+            for host, stats in latency.items()
+        }
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""
+Completion backends for writing the agenda. OpenAIBackend is the real thing; StubBackend
+replays a canned agenda with simulated latency so the pipeline can be run and timed
+offline (see bench_agenda.py).
+
+The backend is picked by the 'llm_backend' preference ('openai' or 'stub'), or the
+UNDERWOOD_LLM_BACKEND environment variable, and the model by 'llm_model'.
+"""
+
+############## DEPENDENCIES ##############
+
+# openai is imported where it's first used
+
+import os
+import time
+from abc import ABC, abstractmethod
+
+############## BACKENDS ##############
+
+DEFAULT_MODEL = 'gpt-4-turbo'
+REQUEST_TIMEOUT = 60  # seconds
+MAX_RETRIES = 2
+
+class CompletionBackend(ABC):
+    """Turn chat messages into text, either all at once or as a stream of deltas."""
+
+    @abstractmethod
+    def complete(self, messages):
+        """Return the whole completion."""
+
+    @abstractmethod
+    def stream(self, messages):
+        """Yield the completion in pieces as they arrive."""
+
+class OpenAIBackend(CompletionBackend):
+
+    def __init__(self, model=DEFAULT_MODEL, timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES):
+        from openai import OpenAI
+
+        self.model = model
+        self.client = OpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            timeout=timeout,
+            max_retries=max_retries
+        )
+
+    def complete(self, messages):
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages
+        )
+        return response.choices[0].message.content
+
+    def stream(self, messages):
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True
+        )
+        for chunk in stream:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content
+
+CANNED_AGENDA = """Good morning! It's Monday, January 1, 2024, and Mr. Underwood is at your service.
+
+Your inbox has one thing that needs you: Pat wants the quarterly numbers by noon. Everything else can wait for a second cup of coffee.
+
+On the calendar: the dentist at 3 PM today, and New Year's Day means the post office is closed. Dress warmly - it's a chilly 28 degrees with flurries this afternoon.
+
+"The secret of getting ahead is getting started." - Mark Twain
+
+Onward and upward!"""
+
+class StubBackend(CompletionBackend):
+    """
+    Replay `text` (by default a canned agenda) after `first_token_delay` seconds, then
+    at `chars_per_second`, in small deltas the way a streaming API sends them.
+    """
+
+    def __init__(self, text=CANNED_AGENDA, first_token_delay=0.0, chars_per_second=None, delta_size=4):
+        self.text = text
+        self.first_token_delay = first_token_delay
+        self.chars_per_second = chars_per_second
+        self.delta_size = delta_size
+        self.calls = []
+
+    def complete(self, messages):
+        self.calls.append(messages)
+        time.sleep(self.first_token_delay)
+        if self.chars_per_second:
+            time.sleep(len(self.text) / self.chars_per_second)
+        return self.text
+
+    def stream(self, messages):
+        self.calls.append(messages)
+        time.sleep(self.first_token_delay)
+        for i in range(0, len(self.text), self.delta_size):
+            delta = self.text[i:i + self.delta_size]
+            if self.chars_per_second:
+                time.sleep(len(delta) / self.chars_per_second)
+            yield delta
+
+def get_backend(prefs):
+    """Return the backend the preferences (or UNDERWOOD_LLM_BACKEND) ask for."""
+    name = os.getenv('UNDERWOOD_LLM_BACKEND') or prefs.get('llm_backend') or 'openai'
+    if name == 'stub':
+        return StubBackend()
+    if name != 'openai':
+        print(f"Unknown LLM backend '{name}', using OpenAI.")
+    return OpenAIBackend(prefs.get('llm_model') or DEFAULT_MODEL)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+############## DEPENDENCIES ##############
+
+import os
+import json
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
+
+############## PREFS ##############
+
+PREFS_PATH = '/home/underwood/prefs.json'
+LOCK_PATH = '/home/underwood/prefs.lock'
+
+DEFAULT_PREFS = {
+    'first_boot': True,
+    'lat': None,
+    'lng': None,
+    'fname': None,
+    'lname': None,
+    'city': None,
+    'state': None
+}
+
+_cache = None
+_cache_stamp = None
+_lock = threading.RLock()
+_lock_depth = 0
+
+@contextmanager
+def prefs_lock():
+    """Hold the prefs lock, shared between threads and between the listener and agenda processes."""
+    global _lock_depth
+
+    with _lock:
+        if _lock_depth:
+            # Already held by this thread; flock() on a second descriptor would deadlock
+            _lock_depth += 1
+            try:
+                yield
+            finally:
+                _lock_depth -= 1
+            return
+
+        with open(LOCK_PATH, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _lock_depth = 1
+            try:
+                yield
+            finally:
+                _lock_depth = 0
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def file_stamp():
+    """Identify the current version of prefs.json, or None if there isn't one."""
+    try:
+        stat = os.stat(PREFS_PATH)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def load_preferences():
+    """
+    Load preferences, creating the file with default settings if it does not exist.
+    The parsed file is cached in memory and only re-read once it changes on disk.
+    """
+    global _cache, _cache_stamp
+
+    with _lock:
+        stamp = file_stamp()
+        if _cache is not None and stamp == _cache_stamp:
+            return dict(_cache)
+
+        if stamp is None or stamp[2] == 0:
+            # Write default preferences if the file is missing or blank
+            return reset_preferences()
+
+        try:
+            with open(PREFS_PATH, 'r') as file:
+                loaded = json.load(file)
+        except ValueError as e:
+            print(f"Error reading preferences, using defaults: {e}")
+            return dict(DEFAULT_PREFS)
+
+        # Fill in any settings added since the file was written
+        _cache = {**DEFAULT_PREFS, **loaded}
+        _cache_stamp = stamp
+        return dict(_cache)
+
+def save_preferences(preferences):
+    """Save preferences by writing a temporary file and renaming it over prefs.json."""
+    global _cache, _cache_stamp
+
+    with prefs_lock():
+        atomic_write_json(PREFS_PATH, preferences, mode=0o644, indent=4)
+        _cache = {**DEFAULT_PREFS, **preferences}
+        _cache_stamp = file_stamp()
+
+def update_preferences(**changes):
+    """Change some preferences in one locked read-modify-write, so no other writer's changes are lost."""
+    with prefs_lock():
+        prefs = load_preferences()
+        prefs.update(changes)
+        save_preferences(prefs)
+        return prefs
+
+def reset_preferences():
+    """Overwrite prefs.json with the default settings."""
+    save_preferences(DEFAULT_PREFS)
+    return dict(DEFAULT_PREFS)
+
+############## FILES ##############
+
+def atomic_write(path, data, mode=None):
+    """
+    Write `data` (text, or bytes) to a uniquely named temporary file beside `path` and
+    rename it over `path`, so readers never see a half-written file and concurrent writers
+    can't clobber each other's temporary files. Raises OSError.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}-')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def atomic_write_json(path, data, mode=None, **dump_args):
+    """Atomically write `data` as JSON to `path` (see atomic_write)."""
+    atomic_write(path, json.dumps(data, **dump_args), mode)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+Ranks the emails, calendar events and news headlines going into the agenda prompt,
+and packs the best of them into a fixed token budget so a busy inbox can't produce a
+huge, slow and costly prompt.
+
+Each rank_* function returns (score, item) pairs in the order it was given them, with
+scores between 0 and 1 so the sections can compete for the same budget.
+"""
+
+############## DEPENDENCIES ##############
+
+import math
+from datetime import datetime, timezone
+from email.utils import parseaddr
+
+############## TOKENS ##############
+
+TOKEN_BUDGET = 1500  # Default, overridden by the 'prompt_token_budget' preference
+CHARS_PER_TOKEN = 4  # A rough average for English text with GPT tokenizers
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+############## EMAILS ##############
+
+# Gmail's tabs, and how much less they tend to matter than the Primary inbox
+CATEGORY_WEIGHTS = {
+    'CATEGORY_PROMOTIONS': 0.2,
+    'CATEGORY_SOCIAL': 0.4,
+    'CATEGORY_FORUMS': 0.5,
+    'CATEGORY_UPDATES': 0.6
+}
+BOOSTED_LABELS = {'IMPORTANT': 1.5, 'STARRED': 1.5}
+BULK_WEIGHT = 0.4  # Mailing lists and newsletters (List-Unsubscribe, Precedence: bulk)
+AUTOMATED_WEIGHT = 0.5  # Auto-Submitted mail (notifications, auto-replies)
+RECENCY_HALF_LIFE = 24  # hours
+
+def header(msg, name):
+    headers = msg.get('payload', {}).get('headers', [])
+    return next((h['value'] for h in headers if h['name'].lower() == name.lower()), None)
+
+def sender_address(msg):
+    return parseaddr(header(msg, 'From') or '')[1].lower()
+
+def rank_emails(messages, now=None):
+    """
+    Score metadata-format Gmail messages: down-weight promotional tabs, mailing lists,
+    automated mail and senders who sent several messages, and favour recent mail.
+    """
+    now = now or datetime.now(timezone.utc).timestamp()
+
+    sent_by = {}
+    for msg in messages:
+        sender = sender_address(msg)
+        sent_by[sender] = sent_by.get(sender, 0) + 1
+
+    ranked = []
+    for msg in messages:
+        labels = msg.get('labelIds', [])
+        score = min([CATEGORY_WEIGHTS[label] for label in labels if label in CATEGORY_WEIGHTS], default=1.0)
+        for label in labels:
+            score *= BOOSTED_LABELS.get(label, 1)
+
+        precedence = (header(msg, 'Precedence') or '').lower()
+        if header(msg, 'List-Unsubscribe') or header(msg, 'List-Id') or precedence in ('bulk', 'list', 'junk'):
+            score *= BULK_WEIGHT
+        if (header(msg, 'Auto-Submitted') or 'no').lower() != 'no':
+            score *= AUTOMATED_WEIGHT
+
+        # Someone who sent ten messages is probably a notification feed
+        score /= math.sqrt(sent_by[sender_address(msg)])
+
+        age_hours = max(0, now - int(msg.get('internalDate', now * 1000)) / 1000) / 3600
+        score *= 0.5 + 0.5 * 0.5 ** (age_hours / RECENCY_HALF_LIFE)
+
+        ranked.append((min(score, 1.0), msg))
+    return ranked
+
+############## EVENTS ##############
+
+def event_start(event):
+    """Return when an event starts as an aware datetime (all-day events start at local midnight)."""
+    start = event['start']
+    if 'dateTime' in start:
+        return datetime.fromisoformat(start['dateTime'].replace('Z', '+00:00'))
+    return datetime.fromisoformat(start['date']).astimezone()
+
+def rank_events(events, now=None):
+    """Score (event, weight) pairs by how soon each event starts: today scores 1, a week out about 1/8."""
+    now = now or datetime.now(timezone.utc)
+
+    ranked = []
+    for event, weight in events:
+        try:
+            days_until = max(0, (event_start(event) - now).total_seconds() / 86400)
+        except (KeyError, ValueError):
+            days_until = 7
+        ranked.append((weight / (1 + days_until), event))
+    return ranked
+
+############## NEWS ##############
+
+def rank_news(items):
+    """Trust Bing's own relevance order, from 1 for the top story down to 0.5."""
+    return [(1 - 0.5 * i / max(1, len(items)), item) for i, item in enumerate(items)]
+
+############## PACKING ##############
+
+def pack(sections, budget=TOKEN_BUDGET):
+    """
+    Keep the highest-scoring lines from `sections` ({name: [(score, line)]}) that fit in
+    `budget` tokens. Returns {name: [line]} with each section's lines in their original
+    order, and prints the token count before and after.
+    """
+    candidates = []
+    for name, lines in sections.items():
+        for order, (score, line) in enumerate(lines):
+            candidates.append((score, name, order, line))
+
+    before = sum(estimate_tokens(line) for _, _, _, line in candidates)
+    kept = []
+    used = 0
+    for score, name, order, line in sorted(candidates, key=lambda candidate: candidate[0], reverse=True):
+        tokens = estimate_tokens(line)
+        if used + tokens <= budget:
+            kept.append((name, order, line))
+            used += tokens
+
+    packed = {name: [] for name in sections}
+    for name, order, line in sorted(kept, key=lambda item: (item[0], item[1])):
+        packed[name].append(line)
+
+    print(f"[prompt] packed {len(kept)}/{len(candidates)} items: ~{before} -> ~{used} tokens (budget {budget})")
+    return packed
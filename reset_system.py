@@ -1,70 +1,67 @@
 ############## EXTERNAL FUNCTIONS ##############
 
 import underwood_listener
+import typewriter
+import schedule_agenda
+import http_client
+import google_services
+import google_credentials
+import generate_agenda
+import get_connected
+import snapshot_store
+from preferences import reset_preferences
 
 import os
-import json
-import shutil
-from queue import Queue, Empty
-import pickle
-import requests
-from crontab import CronTab
-from dotenv import load_dotenv
-load_dotenv()
+from queue import Empty
 
 def reset_system(message_queue):
     """Reset the system by deleting configuration files and revoking Google OAuth tokens."""
+    from crontab import CronTab
     
     underwood_listener.clear_queue()
 
     underwood_listener.send_text("Are you sure you'd like to completely reset the system? This will sever the connection to your Google account, and delete all Wi-Fi settings. Type 'reset' and hit the RETURN key to confirm, or hit the BACKSPACE key to cancel.")
 
     try:
-        raw_data = message_queue.get(timeout=30)
-        if raw_data:
-            if b'\x7f' in raw_data:  # Check for character 127 (DEL)
+        event = message_queue.get(timeout=30)
+        if event:
+            if event.kind == typewriter.CANCEL:  # BACKSPACE
                 underwood_listener.send_text("Your request to reset the system has been canceled.")
                 return
             else:
 
-                choice = raw_data.decode('utf-8').strip().lower()
+                choice = event.text.lower()
                 if choice == 'reset':
     
                     cron = CronTab(user='root')
-                    job_comment = 'generate_agenda_job'
-                    jobs = list(cron.find_comment(job_comment))
+                    jobs = list(cron.find_comment(schedule_agenda.JOB_COMMENT))
                     
                     if jobs:
                         job = jobs[0]
                         job.delete()
                         cron.write()
+                        schedule_agenda.forget_schedule()
 
-                    prefs_path = '/home/underwood/prefs.json'
-
-                    default_prefs = {
-                            'first_boot': True,
-                            'lat': None,
-                            'lng': None,
-                            'fname': None,
-                            'lname': None,
-                            'city': None,
-                            'state': None
-                    }
-
-                    # Delete prefs.json
-                    if os.path.exists(prefs_path):
-                        os.remove(prefs_path)
-                        
-                    # Create the prefs.json file with default preferences
-                    with open(prefs_path, 'w') as file:
-                        json.dump(default_prefs, file, indent=4)
+                    # Overwrite prefs.json with the default preferences
+                    reset_preferences()
                 
                     # Optionally, revoke the Google OAuth token
                     revoke_google_oauth_token()
      
-                    # Delete token.pickle
-                    if os.path.exists('/home/underwood/token.pickle'):
-                        os.remove('/home/underwood/token.pickle')
+                    # Then drop them and delete token.pickle
+                    google_credentials.manager.forget()
+                    google_services.forget_services()
+
+                    # Delete the agendas, mail and whereabouts kept on-device, so the next user never sees them
+                    remove_file(generate_agenda.PREFETCH_PATH)
+                    remove_file(generate_agenda.AGENDA_CACHE_PATH)
+                    remove_file(generate_agenda.GMAIL_INDEX_PATH)
+                    remove_file(generate_agenda.FORECAST_CACHE_PATH)
+                    remove_file(get_connected.LOCATION_CACHE_PATH)
+                    try:
+                        snapshot_store.forget_snapshot()
+                    except OSError as e:
+                        print(f"Error deleting the offline snapshot: {e}")
 
                     # Update wpa_supplicant.conf with new network details
                     underwood_listener.reset_wpa()
@@ -80,11 +77,25 @@ def reset_system(message_queue):
         underwood_listener.send_text("I'm sorry, I didn't catch that. I'll go ahead and cancel this request, but please feel free to try again!")
         return
 
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error deleting {path}: {e}")
+
 def revoke_google_oauth_token():
-    """Revoke the Google OAuth token programmatically if possible."""
-    # Assuming token.pickle loads into a Credentials object
-    if os.path.exists('/home/underwood/token.pickle'):
-        with open('/home/underwood/token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-            requests.post('https://accounts.google.com/o/oauth2/revoke', params={'token': creds.token},
-						  headers={'content-type': 'application/x-www-form-urlencoded'})
\ No newline at end of file
+    """Revoke the current Google credentials' grant, if there are any."""
+    import requests
+
+    credentials = google_credentials.manager.get()
+    if credentials is None:
+        return
+
+    # Revoking the refresh token revokes the whole grant, access token included
+    try:
+        http_client.post('https://accounts.google.com/o/oauth2/revoke', params={'token': credentials.refresh_token or credentials.token},
+                         headers={'content-type': 'application/x-www-form-urlencoded'})
+    except requests.RequestException as e:
+        print(f"Error revoking the Google token: {e}")
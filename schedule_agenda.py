@@ -1,24 +1,66 @@
 ############## EXTERNAL FUNCTIONS ##############
 
 import underwood_listener
+import typewriter
 
 ############## DEPENDENCIES ##############
 
-import json
-from typing import List
-import recognizers_suite as Recognizers
-from recognizers_suite import Culture, ModelResult
-from crontab import CronTab
-from queue import Queue, Empty
-from datetime import datetime
+# crontab and the (very heavy) recognizers_suite are imported where they're first used
+
+from queue import Empty
+from datetime import datetime, timedelta
 import time
-from dotenv import load_dotenv
-load_dotenv()
+
+# Asks the running listener to print the agenda (see underwood_ctl.py)
+AGENDA_COMMAND = 'sudo -E /usr/bin/python /home/underwood/underwood_ctl.py agenda'
+JOB_COMMENT = 'generate_agenda_job'
+
+SCHEDULE_CACHE_SECONDS = 15 * 60  # Reading the crontab runs `crontab -l`, so don't do it every minute
+
+_schedule = None
+_schedule_read_at = 0
+
+def scheduled_time():
+    """Return the (hour, minute) the agenda is scheduled to print at each day, or None if it isn't scheduled."""
+    from crontab import CronTab
+    global _schedule, _schedule_read_at
+
+    if time.time() - _schedule_read_at < SCHEDULE_CACHE_SECONDS:
+        return _schedule
+
+    _schedule = None
+    jobs = list(CronTab(user='root').find_comment(JOB_COMMENT))
+    if jobs and jobs[0].is_enabled():
+        try:
+            _schedule = (int(str(jobs[0].hour)), int(str(jobs[0].minute)))
+        except ValueError:
+            print(f"Can't prefetch for an agenda scheduled at '{jobs[0].slices}'.")
+    _schedule_read_at = time.time()
+    return _schedule
+
+def next_scheduled_time():
+    """Return the datetime the agenda will next print at, or None if it isn't scheduled."""
+    schedule = scheduled_time()
+    if schedule is None:
+        return None
+
+    now = datetime.now()
+    scheduled = now.replace(hour=schedule[0], minute=schedule[1], second=0, microsecond=0)
+    if scheduled <= now:
+        scheduled += timedelta(days=1)
+    return scheduled
+
+def forget_schedule():
+    """Re-read the crontab next time, after changing it."""
+    global _schedule_read_at
+    _schedule_read_at = 0
 
 def schedule_agenda(message_queue):
     """Manage the scheduling of the agenda generation with an overall timeout."""
+    from crontab import CronTab
+
     cron = CronTab(user='root')
-    job_comment = 'generate_agenda_job'
+    job_comment = JOB_COMMENT
     jobs = list(cron.find_comment(job_comment))
 
     underwood_listener.clear_queue()
@@ -41,17 +83,18 @@ def schedule_agenda(message_queue):
                 underwood_listener.send_text("I'm sorry, I didn't quite catch that. Please try scheduling your agenda again.")
                 return
 
-            raw_data = message_queue.get(timeout=remaining_time)  # Adjust timeout based on elapsed time
-            if raw_data:
-                if b'\x7f' in raw_data:  # Check for DEL character
+            event = message_queue.get(timeout=remaining_time)  # Adjust timeout based on elapsed time
+            if event:
+                if event.kind == typewriter.CANCEL:  # BACKSPACE
                     underwood_listener.send_text("Your request to adjust your schedule has been canceled.")
                     return
                 else:
-                    choice = raw_data.decode('utf-8').strip().lower()
+                    choice = event.text.lower()
                     try:
                         if choice == 'delete':
                             job.delete()
                             cron.write()
+                            forget_schedule()
                             underwood_listener.send_text("I've deleted your schedule! You can always set up another one by hitting the RELOC key.")
                             return
                         elif choice in ['change', 'set']:
@@ -65,11 +108,17 @@ def schedule_agenda(message_queue):
 
 def handle_time_change(choice, cron, jobs, job_comment, message_queue, start_time, timeout_duration):
     """Handles the user's request to change or set the schedule with a timeout."""
+    from recognizers_suite import Culture
+
     job = None
     if jobs and choice == 'change':
         job = jobs[0]
     elif choice == 'set':
-        job = cron.new(command='sudo -E /usr/bin/python /home/underwood/generate_agenda.py', comment=job_comment)
+        job = cron.new(command=AGENDA_COMMAND, comment=job_comment)
+
+    # Older schedules launched generate_agenda.py directly
+    if job is not None:
+        job.set_command(AGENDA_COMMAND)
 
     while True:
         elapsed_time = time.time() - start_time
@@ -80,10 +129,10 @@ def handle_time_change(choice, cron, jobs, job_comment, message_queue, start_tim
 
         underwood_listener.send_text("What time would you like to receive your daily agenda? (e.g., '4:35 pm')")
         try:
-            time_data = message_queue.get(timeout=remaining_time)
-            if time_data:
+            event = message_queue.get(timeout=remaining_time)
+            if event.text:
                 underwood_listener.send_text("Give me a few moments to set up your schedule.")
-                new_time_str = time_data.decode('utf-8').strip()
+                new_time_str = event.text
                 new_time = parse_time_with_recognizer(new_time_str, Culture.English)
                 if new_time:
                     hour = new_time.hour
@@ -92,6 +141,7 @@ def handle_time_change(choice, cron, jobs, job_comment, message_queue, start_tim
                     job.minute.on(minute)
                     job.hour.on(hour)
                     cron.write()
+                    forget_schedule()
                     underwood_listener.send_text(f"Scheduled! You'll receive your daily agenda at {new_time.strftime('%-I:%M %p')}.")
                     return
                 else:
@@ -104,6 +154,8 @@ def handle_time_change(choice, cron, jobs, job_comment, message_queue, start_tim
 
 def parse_time_with_recognizer(user_input: str, culture: str):
     """Use Microsoft's Recognizers to parse a natural language time input into a time object."""
+    import recognizers_suite as Recognizers
+
     results = Recognizers.recognize_datetime(user_input, culture)
     # We expect 'results' to be a list of ModelResult instances.
 
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""
+A small SQLite snapshot of the latest calendar events, emails and forecast, saved after
+every successful fetch, so that when the device is offline it can still print a plain
+agenda from what it knew last, without the LLM.
+"""
+
+############## DEPENDENCIES ##############
+
+import os
+import time
+import sqlite3
+from datetime import datetime, timedelta
+from email.utils import parseaddr
+
+import prompt_budget
+
+############## STORE ##############
+
+SNAPSHOT_PATH = '/home/underwood/snapshot.db'
+EMAIL_RETENTION = 2 * 24 * 60 * 60  # seconds
+FORECAST_MAX_AGE = 24 * 60 * 60  # Older forecasts aren't worth printing, in seconds
+OFFLINE_EMAILS = 8
+OFFLINE_EVENTS = 15
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    calendar TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    start_ts REAL NOT NULL,
+    all_day INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_start ON events (start_ts);
+
+CREATE TABLE IF NOT EXISTS emails (
+    id TEXT PRIMARY KEY,
+    received_ts REAL NOT NULL,
+    sender TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    score REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS emails_received ON emails (received_ts);
+
+CREATE TABLE IF NOT EXISTS forecast (
+    position INTEGER PRIMARY KEY,
+    line TEXT NOT NULL,
+    fetched_ts REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+CALENDARS = ['primary_events', 'additional_events', 'birthdays']
+
+def connect(path=None):
+    connection = sqlite3.connect(path or SNAPSHOT_PATH, timeout=5)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+def save_snapshot(sources, skip=(), path=None):
+    """Save the fetched sources, leaving alone any in `skip` (the ones that failed to fetch)."""
+    now = time.time()
+    with connect(path) as connection:
+        for calendar in CALENDARS:
+            if calendar in skip:
+                continue
+            # Each fetch returns the calendar's whole upcoming week, so replace it
+            connection.execute('DELETE FROM events WHERE calendar = ?', (calendar,))
+            for event in sources[calendar]:
+                try:
+                    start_ts = prompt_budget.event_start(event).timestamp()
+                except (KeyError, ValueError):
+                    continue
+                connection.execute(
+                    'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)',
+                    (event.get('id', f'{calendar}:{start_ts}'), calendar, event.get('summary', 'Untitled event'), start_ts, 'date' in event['start'])
+                )
+
+        if 'emails' not in skip:
+            for score, msg in prompt_budget.rank_emails(sources['emails']):
+                sender = prompt_budget.header(msg, 'From') or 'Unknown Sender'
+                connection.execute(
+                    'INSERT OR REPLACE INTO emails VALUES (?, ?, ?, ?, ?)',
+                    (msg['id'], int(msg.get('internalDate', now * 1000)) / 1000, parseaddr(sender)[0] or sender, prompt_budget.header(msg, 'Subject') or 'No Subject', score)
+                )
+            connection.execute('DELETE FROM emails WHERE received_ts < ?', (now - EMAIL_RETENTION,))
+
+        # get_forecast apologises instead of raising, so only keep forecasts with periods in them
+        if 'forecast' not in skip and ': ' in sources['forecast']:
+            connection.execute('DELETE FROM forecast')
+            for position, line in enumerate(sources['forecast'].splitlines()):
+                connection.execute('INSERT INTO forecast VALUES (?, ?, ?)', (position, line, now))
+
+        connection.execute("INSERT OR REPLACE INTO meta VALUES ('saved_at', ?)", (str(now),))
+
+def has_snapshot(path=None):
+    return os.path.exists(path or SNAPSHOT_PATH)
+
+def forget_snapshot(path=None):
+    """Delete the snapshot, and SQLite's WAL files beside it, e.g. when the system is reset."""
+    path = path or SNAPSHOT_PATH
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+############## OFFLINE AGENDA ##############
+
+def render_offline_agenda(fname=None, path=None, now=None):
+    """Write a plain agenda from the snapshot: upcoming events, the most important recent emails and the forecast."""
+    now = now or datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    with connect(path) as connection:
+        saved_at = connection.execute("SELECT value FROM meta WHERE key = 'saved_at'").fetchone()
+        events = connection.execute(
+            'SELECT summary, start_ts, all_day FROM events WHERE start_ts >= ? AND start_ts < ? ORDER BY start_ts LIMIT ?',
+            (today.timestamp(), (today + timedelta(days=7)).timestamp(), OFFLINE_EVENTS)
+        ).fetchall()
+        emails = connection.execute(
+            'SELECT sender, subject FROM (SELECT * FROM emails WHERE received_ts >= ?) ORDER BY score DESC, received_ts DESC LIMIT ?',
+            (now.timestamp() - EMAIL_RETENTION, OFFLINE_EMAILS)
+        ).fetchall()
+        forecast = connection.execute(
+            'SELECT line FROM forecast WHERE fetched_ts >= ? ORDER BY position',
+            (now.timestamp() - FORECAST_MAX_AGE,)
+        ).fetchall()
+
+    time_of_day = 'morning' if 4 <= now.hour < 12 else 'afternoon' if 12 <= now.hour < 17 else 'evening'
+    greeting = f"Good {time_of_day}, {fname}!" if fname else f"Good {time_of_day}!"
+    lines = [f"{greeting} It's {now.strftime('%A, %B %-d, %Y')}."]
+    if saved_at:
+        saved = datetime.fromtimestamp(float(saved_at[0]))
+        lines.append(f"I can't get online right now, so here's what I knew as of {saved.strftime('%A at %-I:%M %p')}.")
+    lines.append("")
+
+    lines.append("CALENDAR:")
+    for summary, start_ts, all_day in events:
+        start = datetime.fromtimestamp(start_ts)
+        lines.append(f"{start.strftime('%a')} {'(all day)' if all_day else start.strftime('%-I:%M %p')} - {summary}")
+    if not events:
+        lines.append("Nothing on the calendar this week.")
+    lines.append("")
+
+    lines.append("EMAILS:")
+    for sender, subject in emails:
+        lines.append(f"{sender}: {subject}")
+    if not emails:
+        lines.append("No recent emails.")
+    lines.append("")
+
+    if forecast:
+        lines.append("WEATHER:")
+        lines.extend(line for (line,) in forecast)
+        lines.append("")
+
+    lines.append("I'll be back to my usual self once we're online again. Hit the RELOC key if you'd like to set up Wi-Fi.")
+    return "\n".join(lines)
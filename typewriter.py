@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+
+############## DEPENDENCIES ##############
+
+import os
+import re
+import time
+import unicodedata
+from collections import namedtuple
+from threading import Thread, Condition
+from queue import Queue, Empty
+
+############## LINK PROTOCOL ##############
+
+# Pi -> Arduino: every byte is one keystroke, apart from these
+START_TX = b'\x1e'  # RS: start of a transmission, waits for paper if needed
+END_TX = b'\x1f'  # US: end of a transmission
+ENQ = b'\x05'  # Ask the firmware how many bytes it can accept
+
+# Arduino -> Pi: typed input arrives as lines, interleaved with these
+ACK = b'\x06'  # A byte has been typed (or dropped), freeing one slot
+ETB = b'\x17'  # A carriage return has finished, freeing one slot
+DC1 = b'\x11'  # Reply to ENQ, followed by one byte: the number of free slots in the firmware's buffer
+
+SERIAL_PORT = '/dev/ttyACM0'
+BAUD_RATE = 115200
+READ_TIMEOUT = 1.0  # Reads block for up to this long rather than spinning
+
+DEFAULT_WINDOW = 60  # Used until the firmware advertises its buffer size
+HANDSHAKE_TIMEOUT = 1.0
+
+# Pacing used if the firmware never answers (older sketches don't speak the protocol)
+LEGACY_SECONDS_PER_BYTE = 0.2
+LEGACY_SECONDS_PER_LINE = 1.2
+
+def open_port(path=None):
+    """Open the serial connection to the Arduino, or the loopback stand-in if path is 'loopback'."""
+    path = path or os.getenv('UNDERWOOD_SERIAL_PORT', SERIAL_PORT)
+    if path == 'loopback':
+        port = LoopbackSerial()
+        port.timeout = READ_TIMEOUT
+        return port
+
+    import serial
+    return serial.Serial(path, BAUD_RATE, timeout=READ_TIMEOUT)
+
+class LinkDecoder:
+    """Split bytes from the firmware into flow-control messages and typed input."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.expect_credit = False
+
+    def feed(self, data):
+        """Apply any flow-control messages in `data` and return the remaining typed bytes."""
+        typed = bytearray()
+        acks = lines = 0
+        for byte in data:
+            if self.expect_credit:
+                self.engine.handle_ack(acks, lines)
+                acks = lines = 0
+                self.engine.handle_credit(byte)
+                self.expect_credit = False
+            elif byte == ACK[0]:
+                acks += 1
+            elif byte == ETB[0]:
+                acks += 1
+                lines += 1
+            elif byte == DC1[0]:
+                self.expect_credit = True
+            else:
+                typed.append(byte)
+        if acks:
+            self.engine.handle_ack(acks, lines)
+        return bytes(typed)
+
+############## CHARACTER SET ##############
+
+# Everything the firmware has a key for (KEYS and SHIFT_KEYS in underwood-rx-tx.ino).
+# It drops any other byte, after it has already crossed the serial line and used a credit.
+# bench_agenda.py checks this against the .ino with firmware_characters().
+TYPEABLE = frozenset(
+    "abcdefghijklmnopqrstuvwxyz0123456789 '\";:,./=-"
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ!@#$%&*()_+<>?¢"
+)
+TEXT_ENCODING = 'latin-1'  # So the cent sign goes out as the single byte the firmware matches
+FIRMWARE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'underwood-rx-tx.ino')
+
+def firmware_characters(path=FIRMWARE_PATH):
+    """Read the printable characters in the firmware's KEYS and SHIFT_KEYS matrices, to check TYPEABLE against."""
+    with open(path, 'r', encoding='utf-8') as file:
+        source = file.read()
+
+    characters = set()
+    for name in ('KEYS', 'SHIFT_KEYS'):
+        matrix = re.search(r'\b' + name + r'\[\d+\]\[\d+\]\s*=\s*\{(.*?)\};', source, re.S).group(1)
+        for literal in re.findall(r"'(\\.|[^'\\])'", matrix):
+            character = literal[1] if literal.startswith('\\') and literal[1] in "'\"\\" else literal
+            if len(character) == 1 and character.isprintable():
+                characters.add(character)
+    return frozenset(characters)
+
+# The nearest typeable stand-ins for ASCII (and anything anyascii turns into it) without a key
+SUBSTITUTES = {
+    '[': '(',
+    ']': ')',
+    '{': '(',
+    '}': ')',
+    '\\': '/',
+    '|': '/',
+    '`': "'",
+    '~': '-',
+    '^': '',
+    '\t': ' ',
+    '°': ''  # 75°F reads fine as 75F
+}
+
+class CharacterTable(dict):
+    """
+    A str.translate() table taking every code point to what the typewriter should type
+    for it, which may be nothing. Entries are worked out the first time a character is
+    seen and then reused, so printable() costs one pass of str.translate().
+    """
+
+    def __missing__(self, codepoint):
+        value = self[codepoint] = typeable_sequence(chr(codepoint))
+        return value
+
+def typeable_sequence(char):
+    """Return what to type for `char`: itself, a stand-in, a transliteration or nothing."""
+    from anyascii import anyascii
+
+    if char in TYPEABLE:
+        return char
+    if char in SUBSTITUTES:
+        return SUBSTITUTES[char]
+    if unicodedata.category(char)[0] in 'CZ':
+        return ' ' if unicodedata.category(char) == 'Zs' else ''  # Controls, format characters, line breaks
+    if 0x1f1e6 <= ord(char) <= 0x1f1ff:
+        return ' '  # Flags are made of these regional indicators
+    transliterated = anyascii(char)
+    if len(transliterated) > 2 and transliterated.startswith(':') and transliterated.endswith(':'):
+        return ' '  # Emoji come back as :shortcodes:
+    return ''.join(c if c in TYPEABLE else SUBSTITUTES.get(c, '') for c in transliterated)
+
+character_table = CharacterTable((ord(char), char) for char in TYPEABLE)
+extra_spaces = re.compile(' {2,}')
+
+def collapse_spaces(text):
+    return extra_spaces.sub(' ', text)
+
+def printable(text):
+    """Reduce one line of `text` to characters the typewriter can type, collapsing runs of spaces."""
+    return collapse_spaces(text.translate(character_table))
+
+def encode_text(text):
+    """Encode already printable text as the bytes to send."""
+    return text.encode(TEXT_ENCODING)
+
+############## INPUT ##############
+
+# Kinds of InputEvent
+MENU = 'menu'  # RELOC key (NAK)
+AGENDA = 'agenda'  # EXPR key (SYN)
+RESET_WIFI = 'reset_wifi'  # SUB
+CANCEL = 'cancel'  # BACKSPACE key (DEL)
+LINE = 'line'  # A line of typed text, sent when RETURN is hit
+
+CONTROL_KEYS = {
+    0x15: MENU,
+    0x16: AGENDA,
+    0x1a: RESET_WIFI,
+    0x7f: CANCEL
+}
+
+InputEvent = namedtuple('InputEvent', ['kind', 'text'])
+
+class InputParser:
+    """Turn typed input from the firmware into InputEvents, one per line it sends."""
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        """Add typed bytes and return the events for any lines they complete."""
+        events = []
+        self.buffer += data
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            event = parse_line(line)
+            if event:
+                events.append(event)
+        return events
+
+def parse_line(line):
+    """Parse one line from the firmware into an InputEvent, or None if it's blank."""
+    for byte in line:
+        if byte in CONTROL_KEYS:
+            return InputEvent(CONTROL_KEYS[byte], '')
+
+    text = line.decode('utf-8', errors='replace').strip()
+    if text:
+        return InputEvent(LINE, text)
+    return None
+
+############## OUTPUT ENGINE ##############
+
+class OutputEngine:
+    """
+    Write to the typewriter from a dedicated thread.
+
+    Callers queue whole lines and return straight away. The writer thread sends each
+    line in a single write, and uses credit-based flow control: while idle it asks the
+    firmware (ENQ) how many free slots its serial buffer has, the firmware returns one
+    credit per ACK/ETB, and the engine never has more bytes in flight than it holds
+    credits for.
+    """
+
+    def __init__(self, port, max_lines=64, ack_timeout=30):
+        self.port = port
+        self.ack_timeout = ack_timeout
+        self.lines = Queue(maxsize=max_lines)
+        self.window = DEFAULT_WINDOW
+        self.in_flight = 0
+        self.lines_typed = 0
+        self.credit_mode = False
+        self.acks_seen = False
+        self.legacy_deadline = 0
+        self.needs_handshake = True
+        self.enq_pending = 0  # ENQs the firmware hasn't answered yet
+        self.sent_since_enq = False  # Whether bytes went out after the last ENQ, making its answer stale
+        self.acked = Condition()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        """Queue bytes to be typed, blocking only while the output queue is full."""
+        self.lines.put(data)
+
+    def wait(self):
+        """Block until everything queued so far has been typed."""
+        self.lines.join()
+        with self.acked:
+            self.wait_for_room(self.window)
+
+    def cancel(self):
+        """Drop every line that hasn't been sent to the typewriter yet."""
+        try:
+            while True:
+                self.lines.get_nowait()
+                self.lines.task_done()
+        except Empty:
+            pass
+
+    def pending(self):
+        """Return the number of queued lines not yet sent to the typewriter."""
+        return self.lines.qsize()
+
+    def handle_ack(self, count=1, lines=0):
+        """Return `count` credits for bytes the firmware has finished with."""
+        with self.acked:
+            self.acks_seen = True
+            self.in_flight = max(0, self.in_flight - count)
+            self.lines_typed += lines
+            self.acked.notify_all()
+
+    def handle_credit(self, free):
+        """
+        Take the firmware's word for how many bytes it can accept right now, unless bytes
+        were sent after the ENQ it answers: then it no longer counts them, so ACKs stay
+        the only source of credits.
+        """
+        with self.acked:
+            if not self.enq_pending:
+                return
+            self.enq_pending -= 1
+            if self.sent_since_enq:
+                # The reply still frees the slot the ENQ took
+                self.in_flight = max(0, self.in_flight - 1)
+                self.acked.notify_all()
+                return
+            self.credit_mode = True
+            self.acks_seen = True
+            self.window = free
+            self.in_flight = 0
+            self.acked.notify_all()
+
+    def handshake(self):
+        """
+        Ask the firmware for credits while nothing is in flight. Without an answer, fall
+        back to pacing on ACKs alone, or on fixed timings if there aren't any either.
+        """
+        with self.acked:
+            self.credit_mode = False
+            self.send_enq()
+            if not self.acked.wait_for(lambda: self.credit_mode, timeout=HANDSHAKE_TIMEOUT):
+                print("The typewriter didn't advertise any credits.")
+        self.needs_handshake = False
+
+    def run(self):
+        while True:
+            data = self.lines.get()
+            try:
+                if self.needs_handshake:
+                    self.handshake()
+
+                # Lines never exceed the window, but split anything larger just in case
+                for i in range(0, len(data), max(1, self.window)):
+                    chunk = data[i:i + max(1, self.window)]
+                    self.reserve(chunk)
+                    self.port.write(chunk)
+            except Exception as e:
+                print(f"An error occurred while writing to the typewriter: {str(e)}")
+            finally:
+                self.lines.task_done()
+
+    def send_enq(self):
+        """Ask the firmware how much room it has (holding `acked`). The ENQ takes a slot until it's answered."""
+        self.in_flight += 1
+        self.enq_pending += 1
+        self.sent_since_enq = False
+        self.port.write(ENQ)
+
+    def reserve(self, chunk):
+        """Wait until there are credits for `chunk`, then spend them."""
+        with self.acked:
+            while not self.wait_for_room(len(chunk)):
+                # The firmware may just be waiting for paper, so never assume the bytes were
+                # typed. Ask how much room it has if there's a slot for the question, and keep
+                # waiting for ACKs or its answer.
+                print("The typewriter hasn't acknowledged output for a while.")
+                if self.in_flight < self.window:
+                    self.send_enq()
+            self.in_flight += len(chunk)
+            self.sent_since_enq = True
+            if not self.acks_seen:
+                self.legacy_deadline = max(time.monotonic(), self.legacy_deadline) + legacy_duration(chunk)
+
+    def wait_for_room(self, count):
+        """Wait (holding `acked`) until `count` more bytes may be in flight."""
+        fits = lambda: self.in_flight + count <= self.window
+        if self.acks_seen:
+            return self.acked.wait_for(fits, timeout=self.ack_timeout)
+
+        # No ACKs yet, so assume bytes take as long to type as they used to
+        if not self.acked.wait_for(fits, timeout=max(0, self.legacy_deadline - time.monotonic())):
+            self.in_flight = 0
+        return True
+
+def legacy_duration(data):
+    """Estimate how long the original fixed-sleep pacing took to type `data`."""
+    return len(data) * LEGACY_SECONDS_PER_BYTE + data.count(b'\r') * LEGACY_SECONDS_PER_LINE
+
+############## LOOPBACK ##############
+
+class LoopbackSerial:
+    """
+    A stand-in for the serial port that behaves like the firmware, so the link can be
+    exercised without hardware. Bytes written to it are "typed" at a fixed rate into
+    `typed`, answered with ACK/ETB/DC1 just as underwood-rx-tx.ino does, and dropped
+    (and counted in `overflowed`) if they arrive when its buffer is full. Use press()
+    to simulate someone typing on the keyboard.
+    """
+
+    def __init__(self, rx_slots=63, seconds_per_key=0.0, seconds_per_return=0.0):
+        self.rx_slots = rx_slots
+        self.seconds_per_key = seconds_per_key
+        self.seconds_per_return = seconds_per_return
+        self.timeout = None
+        self.is_open = True
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.typed = bytearray()
+        self.overflowed = 0
+        self.changed = Condition()
+        Thread(target=self.firmware, daemon=True).start()
+
+    @property
+    def in_waiting(self):
+        with self.changed:
+            return len(self.tx)
+
+    def write(self, data):
+        with self.changed:
+            room = self.rx_slots - len(self.rx)
+            self.rx += data[:room]
+            self.overflowed += max(0, len(data) - room)
+            self.changed.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        """Read up to `size` bytes, waiting at most `timeout` seconds for the first one."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.tx or not self.is_open, timeout=self.timeout)
+            data = bytes(self.tx[:size])
+            del self.tx[:size]
+            return data
+
+    def readline(self):
+        with self.changed:
+            self.changed.wait_for(lambda: b'\n' in self.tx or not self.is_open, timeout=self.timeout)
+            end = self.tx.find(b'\n') + 1 or len(self.tx)
+            data = bytes(self.tx[:end])
+            del self.tx[:end]
+            return data
+
+    def close(self):
+        with self.changed:
+            self.is_open = False
+            self.changed.notify_all()
+
+    def send(self, data):
+        """Queue bytes from the "firmware" to the Pi."""
+        with self.changed:
+            self.tx += data
+            self.changed.notify_all()
+
+    def press(self, text):
+        """Simulate typing `text` and hitting RETURN on the keyboard."""
+        self.send(text.encode() + b'\r\n')
+
+    def press_key(self, kind):
+        """Simulate hitting a control key, e.g. press_key(AGENDA) for EXPR."""
+        key = next(byte for byte, key_kind in CONTROL_KEYS.items() if key_kind == kind)
+        self.send(bytes([key]) + b'\r\n')
+
+    def firmware(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.rx or not self.is_open)
+                if not self.is_open:
+                    return
+                byte = self.rx[0]
+                del self.rx[0]
+
+            if byte == ENQ[0]:
+                with self.changed:
+                    free = self.rx_slots - len(self.rx)
+                self.send(DC1 + bytes([free]))
+                continue
+
+            if byte == ord('\r'):
+                time.sleep(self.seconds_per_return)
+            elif byte not in (START_TX[0], END_TX[0]):
+                time.sleep(self.seconds_per_key)
+            self.typed.append(byte)
+            self.send(ETB if byte == ord('\r') else ACK)
@@ -5,6 +5,21 @@ const int IR_PIN = 11;
 const int PULSE_GAP_MS = 125;
 const int DEBOUNCE_COUNT = 4;
 const int DEBOUNCE_COUNT_READ = 8;
+const long BAUD_RATE = 115200;
+
+// Link protocol (see typewriter.py). The Pi may only have as many bytes in
+// flight as we have free slots in the serial receive buffer: when it sends ENQ
+// we reply with DC1 <free slots>, and we hand one slot back per ACK (or ETB,
+// for a finished carriage return).
+const char ENQ = 5;
+const char ACK = 6;
+const char DC1 = 17;
+const char ETB = 23;
+#ifdef SERIAL_RX_BUFFER_SIZE
+const int RX_SLOTS = SERIAL_RX_BUFFER_SIZE - 1;
+#else
+const int RX_SLOTS = 63;
+#endif
 
 const int NUM_ROWS = sizeof(ROW_PINS) / sizeof(ROW_PINS[0]);
 const int NUM_COLS = sizeof(COL_PINS) / sizeof(COL_PINS[0]);
@@ -38,7 +53,7 @@ bool isReceiving;
 String outboundString = "";
 
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(BAUD_RATE);
 
   for (int i = 0; i < NUM_ROWS; i++) {
     pinMode(ROW_PINS[i], INPUT_PULLUP);
@@ -70,12 +85,23 @@ void setup() {
   }
 }
 
+void advertiseCredits() {
+  Serial.write(DC1);
+  Serial.write((byte)(RX_SLOTS - Serial.available()));
+}
+
 void loop() {
 
     // Only proceed with serial communication if the IR sensor is active
         if (Serial.available() > 0) {
             char character = Serial.read();
-            sendCharacter(character);
+            if (character == ENQ) {
+                advertiseCredits();
+            } else {
+                sendCharacter(character);
+                // Hand the slot back so the Pi can send the next byte
+                Serial.write(character == '\r' ? ETB : ACK);
+            }
         } else {
             scanKeyboard();
         }
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+"""
+Send a command to the running listener daemon, e.g. from cron:
+
+    python underwood_ctl.py agenda|status|cancel
+
+If the daemon isn't running, 'agenda' falls back to generating the agenda in this process.
+"""
+
+############## DEPENDENCIES ##############
+
+import sys
+import json
+
+############## EXTERNAL FUNCTIONS ##############
+
+from control_socket import send_command
+
+############## LAUNCHER ##############
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+
+    try:
+        response = send_command(command)
+    except OSError as e:
+        if command != 'agenda':
+            print(f"The listener isn't running: {e}")
+            sys.exit(1)
+        print(f"The listener isn't running ({e}), generating the agenda here instead.")
+        import generate_agenda
+        generate_agenda.run_locally()
+        return
+
+    print(json.dumps(response))
+    if not response.get('ok'):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
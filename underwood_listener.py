@@ -2,91 +2,171 @@
 
 ############## DEPENDENCIES ##############
 
+# Only the stdlib and our own lightweight modules are imported up front. The agenda,
+# Wi-Fi, scheduling and reset flows (and the heavy libraries they pull in) are
+# imported when they're first used, and the serial port is opened by connect().
+
 #SYS
 
 from datetime import datetime, timedelta
 import time
-import os
-import serial
-import sys
-import subprocess
-from crontab import CronTab
-from threading import Thread
+from threading import Thread, Lock
 from queue import Queue, Empty
 from dotenv import load_dotenv
 load_dotenv()
 
-#API
-
-import re
-import requests
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import socketserver
-from urllib.parse import urlparse, parse_qs
-import pickle
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from openai import OpenAI
-
 #TXT
 
-import json
 import textwrap
-import emoji
-from anyascii import anyascii
 
 ############## EXTERNAL FUNCTIONS ##############
 
-import generate_agenda
-import get_connected
-import reset_system
-import schedule_agenda
+import typewriter
+import control_socket
+import http_client
+import connectivity
+import wpa_ctrl
+import google_credentials
+from preferences import load_preferences
 
 ############## CONNECT TO ARDUINO ##############
 
-arduino = serial.Serial('/dev/ttyACM0', 9600)
-time.sleep(1 / 5)
+arduino = None
+output = None
+decoder = None
+connect_lock = Lock()
+
+def connect():
+    """Open the serial connection to the Arduino and start the output engine, once."""
+    global arduino, output, decoder
+    with connect_lock:
+        if arduino is None:
+            arduino = typewriter.open_port()
+            time.sleep(1 / 5)
+            output = typewriter.OutputEngine(arduino)
+            decoder = typewriter.LinkDecoder(output)
+    return output
 
 ############## SEND & RECEIVE TEXT ##############
 
 global message_queue
-message_queue = Queue()
+message_queue = Queue()  # Typed input, read by the menus and prompts as well as process_messages()
+control_queue = Queue()  # Requests from the control socket, only ever read by process_messages()
+
+CONTROL_POLL = 1  # How often an idle process_messages() looks for control requests, in seconds
+
+cancel_count = 0  # Bumped by cancel_output() to stop in-progress transmissions
+
+LINE_WIDTH = 55  # Characters per line at 10 cpi
+
+def wrap_paragraph(graf):
+    """Wrap one paragraph to the typewriter's width, with a trailing '' marking the paragraph break."""
+    return textwrap.wrap(graf, width=LINE_WIDTH, break_long_words=True, break_on_hyphens=True) + ['']
 
-def send_text(text):
+def wrap_text(text):
+    """Yield the lines of `text`, reduced to what the typewriter can type, wrapped to its width."""
+    # Split paragraphs exactly as StreamingWrapper does, so streamed text types the same
+    grafs = text.split('\n')
+    if not grafs[-1]:
+        grafs.pop()
+    for graf in grafs:
+        yield from wrap_paragraph(typewriter.printable(graf))
+
+class StreamingWrapper:
+    """
+    Wrap text that arrives in pieces, releasing each line as soon as later text can no
+    longer change it. Greedy wrapping only ever moves the last line, so every line but
+    the last one built from complete words is final.
+    """
+
+    def __init__(self, translate=typewriter.printable):
+        self.translate = translate
+        self.graf = ''  # Translated, complete words of the current paragraph
+        self.partial = ''  # Raw text that may still end mid-word
+
+    def feed(self, delta):
+        """Add the next piece of text and return the lines that are now final."""
+        lines = []
+        self.partial += delta
+
+        while '\n' in self.partial:
+            end, self.partial = self.partial.split('\n', 1)
+            lines.extend(wrap_paragraph(typewriter.collapse_spaces(self.graf + self.translate(end.rstrip('\r')))))
+            self.graf = ''
+
+        cut = max(self.partial.rfind(' '), self.partial.rfind('\t'))
+        if cut >= 0:
+            # Pieces are translated separately, so spaces may run on across their edges
+            self.graf = typewriter.collapse_spaces(self.graf + self.translate(self.partial[:cut + 1]))
+            self.partial = self.partial[cut + 1:]
+            wrapped = textwrap.wrap(self.graf, width=LINE_WIDTH, break_long_words=True, break_on_hyphens=True)
+            if len(wrapped) > 1:
+                lines.extend(wrapped[:-1])
+                self.graf = wrapped[-1] + ' '
+        return lines
+
+    def close(self):
+        """Return the remaining lines once the text is complete."""
+        lines = []
+        if self.graf or self.partial:
+            lines = wrap_paragraph(typewriter.collapse_spaces(self.graf + self.translate(self.partial)))
+        self.graf = self.partial = ''
+        return lines
+
+def send_text(text, wait=True):
     """Send the text to the typewriter, ensuring each line does not exceed 55 characters."""
-    # Wrap the text and split into lines
-    send_character(chr(30)) # control character - start tx
-    
-    textGrafs = text.splitlines()
+    send_lines(wrap_text(text), wait)
 
-    for graf in textGrafs:
-        lines = textwrap.wrap(graf, width=55, break_long_words=True, break_on_hyphens=True)
+def send_lines(lines, wait=True):
+    """
+    Queue already-wrapped, printable lines as a single transmission; '' ends a paragraph.
+    With wait=False this returns as soon as the last line is queued.
+    """
+    engine = connect()
+    cancels = cancel_count
+    engine.write(typewriter.START_TX)
+    try:
         for line in lines:
-            line = anyascii(line)
-            for character in line:
-                send_character(character)
-            # Send carriage return to start a new line
-            send_character('\r')
-            time.sleep(1.2)
-        send_character('\r')
-    send_character(chr(31)) # control character - end tx
-
-def send_character(character):
-    # Assuming an average typing speed, we introduce a slight delay
-    arduino.write(character.encode())
-    time.sleep(0.2)  # Delay to mimic around 200 characters per minute
+            if cancel_count != cancels:
+                break  # Stop consuming (and generating) lines once output is canceled
+            engine.write(encode_line(line))
+    finally:
+        # Always close the transmission, even if generating the lines failed
+        engine.write(typewriter.END_TX)
+    if wait:
+        engine.wait()
+
+def cancel_output():
+    """Drop queued output and stop any transmission that's still being generated."""
+    global cancel_count
+    cancel_count += 1
+    if output is not None:
+        output.cancel()
+
+def encode_line(line):
+    """Encode one line, followed by a carriage return, as the bytes to type."""
+    return typewriter.encode_text(line + '\r')
 
 def receive_typed_text():
-    """Continuously read typed text from the Arduino."""
-    while True:
-        if arduino.in_waiting > 0:
-            raw_data = arduino.readline()
-            message_queue.put(raw_data)
+    """
+    Continuously read from the Arduino, passing flow control to the output engine and
+    queueing typed input as InputEvents. Reads block until data arrives (or the port's
+    timeout passes), so an idle typewriter costs no CPU.
+    """
+    connect()
+    parser = typewriter.InputParser()
+    while arduino.is_open:
+        try:
+            data = arduino.read(arduino.in_waiting or 1)
+        except Exception as e:
+            print(f"An error occurred while reading from the typewriter: {str(e)}")
+            return
+        for event in parser.feed(decoder.feed(data)):
+            message_queue.put(event)
             
 def process_messages():
     """Process messages from the queue indefinitely."""
+    import get_connected
 
     #send_text("Hi there! Just give me a few moments to get ready.")
 
@@ -100,22 +180,36 @@ def process_messages():
         
     while True:
         try:
-            raw_data = message_queue.get()
-            if raw_data:
-                if b'\x15' in raw_data:  # NAK: Open settings menu
-                    settings_menu()
-                elif b'\x16' in raw_data:  # SYN: Prepare agenda
-                    send_text("I'm preparing your agenda. Please hold!")
-                    generate_agenda.generate_agenda(message_queue)
-                elif b'\x1a' in raw_data:  # SUB: Reset Wi-Fi
-                    send_text("I'm resetting Wi-Fi to default. Please hold!")
-                    reset_wpa()
+            event = next_event()
+            if event.kind == typewriter.MENU:  # RELOC: Open settings menu
+                settings_menu()
+            elif event.kind == typewriter.AGENDA:  # EXPR (or a scheduled agenda): Prepare agenda
+                run_agenda()
+            elif event.kind == typewriter.RESET_WIFI:  # SUB: Reset Wi-Fi
+                send_text("I'm resetting Wi-Fi to default. Please hold!")
+                reset_wpa()
         except Empty:
             print("No input detected, please try again.")
         except Exception as e:
             print(f"An error occurred: {str(e)}")
             continue  # Maintain the loop unless a shutdown is initiated
 
+def next_event():
+    """
+    Wait for the next typed event or control request. Control requests wait here until no
+    menu or prompt is open, so a prompt never takes one as its answer.
+    """
+    while True:
+        for queue in (message_queue, control_queue):
+            try:
+                return queue.get_nowait()
+            except Empty:
+                pass
+        try:
+            return message_queue.get(timeout=CONTROL_POLL)
+        except Empty:
+            continue
+
 def clear_queue():
     try:
         while True:  # Keep running until an exception is raised
@@ -125,15 +219,11 @@ def clear_queue():
 
 ############## ONLINE ##############
 
-def is_online(host="8.8.8.8", count=1, timeout=3):
+def is_online(fresh=False):
     """
-    Check if the device is online by pinging a known server.
+    Check if the device is online, from the connectivity monitor's cached state.
     """
-    try:
-        subprocess.check_output(['ping', '-c', str(count), '-W', str(timeout), host], stderr=subprocess.STDOUT)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return connectivity.monitor.is_online(fresh)
 
 def reset_wpa():
     """
@@ -159,7 +249,8 @@ network={{
             file.write(new_config_content)
 
         # Trigger reconfiguration to apply changes
-        subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'reconfigure'], check=True)
+        with wpa_ctrl.WpaCtrl() as wpa:
+            wpa.reconfigure()
         send_text("Wi-Fi has been reset to default. Please hit the RELOC key to add a new network.")
         return
     except Exception as e:
@@ -167,44 +258,13 @@ network={{
 
 ############## PREFS ##############
 
-def load_preferences():
-    """Load preferences from a JSON file, create the file with default settings if it does not exist."""
-    prefs_path = '/home/underwood/prefs.json'
-
-    default_prefs = {
-        'first_boot': True,
-        'lat': None,
-        'lng': None,
-        'fname': None,
-        'lname': None,
-        'city': None,
-        'state': None
-    }
-
-    if os.path.exists(prefs_path):
-        # Check if the file is blank
-        if os.path.getsize(prefs_path) == 0:
-            # Write default preferences to the file if it is blank
-            with open(prefs_path, 'w') as file:
-                json.dump(default_prefs, file, indent=4)
-            return default_prefs
-        else:
-            # Load and return preferences if the file exists and is not blank
-            with open(prefs_path, 'r') as file:
-                return json.load(file)
-    else:
-        # Create the prefs.json file with default preferences if it does not exist
-        with open(prefs_path, 'w') as file:
-            json.dump(default_prefs, file, indent=4)
-        return default_prefs
-
-def save_preferences(preferences):
-    """Save preferences to the JSON file."""
-    with open('/home/underwood/prefs.json', 'w') as file:
-        json.dump(preferences, file, indent=4)
 
 def settings_menu():
     """Display the main menu and handle user choices."""
+    import get_connected
+    import reset_system
+    import schedule_agenda
+
     prefs = load_preferences()
 
     clear_queue()
@@ -222,25 +282,24 @@ def settings_menu():
     
     while True:
         try:
-            raw_data = message_queue.get(timeout=30)  # 30 seconds timeout for user to respond
-            if raw_data:
-                if b'\x7f' in raw_data:  # Check for character 127 (DEL)
+            event = message_queue.get(timeout=30)  # 30 seconds timeout for user to respond
+            if event:
+                if event.kind == typewriter.CANCEL:  # BACKSPACE
                     send_text("Your last action has been canceled!")
                     return
                 else:
-                    choice = raw_data.decode('utf-8').strip()
+                    choice = event.text
                     print(choice)
                     # Process the choice as previously done
                     if choice == '1':
-                        send_text("I'm preparing your agenda. Please hold!")    
-                        generate_agenda.generate_agenda(message_queue)
+                        run_agenda()
                     elif choice == '2':
                         schedule_agenda.schedule_agenda(message_queue)
                     elif choice == '3':
                         get_connected.connect_to_wifi(message_queue)
                     elif choice == '4':
                         send_text("Mr. Underwood uses GPT-4 and various Google APIs to summarize your Gmail inbox and calendar into a daily agenda. Data is processed by a Raspberry Pi Zero 2 W, which controls the typewriter via an Arduino Nano Every.")
-                        send_text("Data is sent to the GPT-4 API for synthesis, but is not retained, accessible, or saved on OpenAI's servers or on-device once each agenda has been generated.")
+                        send_text("Data is sent to the GPT-4 API for synthesis, but is not retained, accessible, or saved on OpenAI's servers. To keep agendas quick, and available offline, the subject lines and previews of recent emails, the next week of calendar events, the forecast and your last few agendas are kept on-device until they age out or the system is reset.")
                         send_text("GPT-4 analyzes subject lines and brief previews from emails received in your inbox over the past 24 hours, as well as calendar events for the next 7 days. Geolocation data is sent to Bing News and NWS APIs for local news and weather.")            
                         send_text("When you're not getting an agenda, you can use the typewriter as one normally would (if this were 1983). The original manual, included in the case, describes all of its functionality. Note that the 'KB I/II' switch brings up special characters, and your agenda will look weird unless you keep it set to 'KB I'. The '10/12/15' switch refers to pitch; Mr. Underwood expects 10 cpi.")            
                         send_text("For questions, issues, concerns or feature requests, reach out to Josh Sucher at *josh@thingswemake.com*.")
@@ -257,16 +316,107 @@ def settings_menu():
             print(f"An error occurred: {str(e)}")
             return  # Exit on other exceptions
 
+############## AGENDA ##############
+
+agenda_running = False
+last_agenda = None
+
+def run_agenda():
+    """Prepare and print the agenda, keeping track of it for the status command."""
+    import generate_agenda
+    global agenda_running, last_agenda
+
+    agenda_running = True
+    try:
+        send_text("I'm preparing your agenda. Please hold!")
+        generate_agenda.generate_agenda(message_queue)
+    finally:
+        agenda_running = False
+        last_agenda = datetime.now().isoformat(timespec='seconds')
+
+############## PREFETCH ##############
+
+PREFETCH_MINUTES = 10  # Default lead time, overridden by the 'prefetch_minutes' preference
+
+def prefetch_scheduler():
+    """Prepare the agenda a few minutes before it's scheduled to print, so it's ready to type straight away."""
+    import generate_agenda
+    import schedule_agenda
+
+    last_prefetched = None
+    while True:
+        delay = 60
+        try:
+            scheduled = schedule_agenda.next_scheduled_time()
+            if scheduled is not None:
+                lead = timedelta(minutes=load_preferences().get('prefetch_minutes', PREFETCH_MINUTES))
+                prefetch_at = scheduled - lead
+                now = datetime.now()
+                if scheduled == last_prefetched:
+                    # Already prefetched; nothing to do until this print time has passed
+                    delay = max(1, min(delay, (scheduled - now).total_seconds()))
+                elif now >= prefetch_at:
+                    last_prefetched = scheduled
+                    if is_online():
+                        generate_agenda.prefetch_agenda()
+                    continue
+                else:
+                    delay = max(1, min(delay, (prefetch_at - now).total_seconds()))
+        except Exception as e:
+            print(f"An error occurred while prefetching the agenda: {str(e)}")
+        time.sleep(delay)
+
+############## CONTROL SOCKET ##############
+
+def request_agenda():
+    """Queue an agenda as if EXPR had been hit, to print once no menu or prompt is open."""
+    control_queue.put(typewriter.InputEvent(typewriter.AGENDA, ''))
+    return {'queued': True}
+
+def report_status():
+    return {
+        'online': is_online(),
+        'agenda_running': agenda_running,
+        'last_agenda': last_agenda,
+        'queued_lines': output.pending() if output else 0,
+        'lines_typed': output.lines_typed if output else 0,
+        'http_latency': http_client.latency_report()
+    }
+
+def cancel():
+    cancel_output()
+    return {'canceled': True}
+
+CONTROL_COMMANDS = {
+    'agenda': request_agenda,
+    'status': report_status,
+    'cancel': cancel
+}
+
 ############## LAUNCHER ##############
 
+control_server = None
+
 def main():
+    global control_server
     
     # Setup threads and resources
+    connect()
+    connectivity.monitor.start()
+    try:
+        control_server = control_socket.ControlServer(CONTROL_COMMANDS).start()
+    except OSError as e:
+        print(f"Couldn't start the control socket: {e}")
     receive_thread = Thread(target=receive_typed_text, daemon=True)
     process_thread = Thread(target=process_messages, daemon=True)
+    prefetch_thread = Thread(target=prefetch_scheduler, daemon=True)
+    # Load the Google credentials now, which also starts their background refresh
+    credentials_thread = Thread(target=google_credentials.manager.get, daemon=True)
 
     receive_thread.start()
     process_thread.start()
+    prefetch_thread.start()
+    credentials_thread.start()
 
     try:
         # Wait indefinitely for threads to complete (they won't if daemon)
@@ -279,8 +429,12 @@ def main():
 
 def shutdown():
     """Close all resources."""
+    if control_server is not None:
+        control_server.stop()
     print("Shutting down. Closing serial connection...")
-    arduino.close()
+    if arduino is not None:
+        output.cancel()
+        arduino.close()
     print("Serial connection closed.")
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+Keeps a table of the Wi-Fi networks in range, refreshed in the background while Wi-Fi
+setup is going on, so looking up a typed network name doesn't wait on the radio.
+Lookups forgive typos and capitalisation: typing on the typewriter is slow, and a
+retype costs the user a minute.
+"""
+
+############## DEPENDENCIES ##############
+
+import time
+from threading import Thread, Condition
+
+import wpa_ctrl
+
+############## SCANNER ##############
+
+SCAN_INTERVAL = 15  # seconds between background scans
+SCAN_TIMEOUT = 10  # seconds to wait for a scan to finish
+MAX_AGE = 120  # Forget access points not seen for this long, in seconds
+IDLE_TIMEOUT = 300  # Stop scanning once nobody has looked anything up for this long
+
+class WifiScanner:
+
+    def __init__(self, interface=wpa_ctrl.INTERFACE):
+        self.interface = interface
+        self.table = {}  # bssid -> {'ssid', 'signal', 'frequency', 'seen_at'}
+        self.scanned_at = 0
+        self.last_used = 0
+        self.running = False
+        self.changed = Condition()
+
+    def start(self):
+        """Scan in the background until the table hasn't been used for IDLE_TIMEOUT."""
+        with self.changed:
+            self.last_used = time.monotonic()
+            if self.running:
+                return self
+            self.running = True
+        Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        try:
+            while time.monotonic() - self.last_used < IDLE_TIMEOUT:
+                try:
+                    self.scan_until_idle()
+                except (OSError, wpa_ctrl.WpaCtrlError) as e:
+                    print(f"Failed to scan for Wi-Fi networks: {e}")
+                    time.sleep(SCAN_INTERVAL)
+        finally:
+            with self.changed:
+                self.running = False
+
+    def scan_until_idle(self):
+        with wpa_ctrl.WpaCtrl(self.interface) as wpa:
+            wpa.attach()
+            next_scan = 0
+            while time.monotonic() - self.last_used < IDLE_TIMEOUT:
+                if time.monotonic() >= next_scan:
+                    wpa.scan()
+                    next_scan = time.monotonic() + SCAN_INTERVAL
+                # wpa_supplicant's own scans count too
+                if wpa.wait_event(['CTRL-EVENT-SCAN-RESULTS'], max(0.1, next_scan - time.monotonic())):
+                    self.update(wpa.scan_results())
+
+    def update(self, results):
+        now = time.time()
+        with self.changed:
+            for result in results:
+                self.table[result['bssid']] = {
+                    'ssid': result['ssid'],
+                    'signal': result['signal'],
+                    'frequency': result['frequency'],
+                    'seen_at': now
+                }
+            self.table = {bssid: entry for bssid, entry in self.table.items() if now - entry['seen_at'] <= MAX_AGE}
+            self.scanned_at = now
+            self.changed.notify_all()
+
+    def rescan(self, timeout=SCAN_TIMEOUT):
+        """Wait (up to `timeout`) for results from a scan started after now."""
+        requested_at = time.time()
+        self.start()
+        try:
+            with wpa_ctrl.WpaCtrl(self.interface) as wpa:
+                wpa.scan()
+        except (OSError, wpa_ctrl.WpaCtrlError) as e:
+            print(f"Failed to scan for Wi-Fi networks: {e}")
+            return False
+        with self.changed:
+            return self.changed.wait_for(lambda: self.scanned_at >= requested_at, timeout=timeout)
+
+    def networks(self):
+        """Return the access points in range, strongest first."""
+        with self.changed:
+            self.last_used = time.monotonic()
+            entries = [dict(entry, bssid=bssid) for bssid, entry in self.table.items()]
+        return sorted(entries, key=lambda entry: entry['signal'], reverse=True)
+
+    def wifi_networks(self):
+        """Return the access points in the shape the Geolocation API takes."""
+        return [{
+            "macAddress": entry['bssid'],
+            "signalStrength": entry['signal'],
+            "ssid": entry['ssid']
+        } for entry in self.networks()]
+
+    def find(self, typed):
+        """Return the visible SSID `typed` most likely means, or None."""
+        ssids = {}
+        for entry in self.networks():
+            if entry['ssid']:
+                ssids.setdefault(entry['ssid'], entry['signal'])
+        return match_ssid(typed, ssids)
+
+############## MATCHING ##############
+
+def levenshtein(a, b):
+    """Count the single-character insertions, deletions and substitutions turning `a` into `b`."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+def match_ssid(typed, ssids):
+    """
+    Pick the SSID (from a {ssid: signal} dict) closest to what was typed, ignoring case
+    and allowing about one typo per four characters. Ties go to the stronger signal.
+    """
+    if typed in ssids:
+        return typed
+
+    typed = typed.strip().casefold()
+    allowed = max(1, len(typed) // 4)
+    ranked = sorted((levenshtein(typed, ssid.casefold()), -signal, ssid) for ssid, signal in ssids.items())
+    if ranked and ranked[0][0] <= allowed:
+        return ranked[0][2]
+    return None
+
+scanner = WifiScanner()
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+"""
+A client for wpa_supplicant's control interface, the Unix datagram socket `wpa_cli`
+talks to, so a whole Wi-Fi setup is one session rather than a `sudo wpa_cli` process
+per command.
+
+    with WpaCtrl() as wpa:
+        network_id = wpa.add_network()
+        wpa.set_network(network_id, 'ssid', hex_ssid('Home'))
+
+Set UNDERWOOD_WPA_CTRL_DIR to point it at another control directory, e.g. one served
+by FakeWpaSupplicant below.
+"""
+
+############## DEPENDENCIES ##############
+
+import os
+import socket
+import tempfile
+import time
+import itertools
+from collections import deque
+from threading import Thread, Timer
+
+############## CONTROL SOCKET ##############
+
+CTRL_DIR = os.getenv('UNDERWOOD_WPA_CTRL_DIR', '/var/run/wpa_supplicant')
+INTERFACE = 'wlan0'
+REPLY_TIMEOUT = 5  # seconds
+BUFFER_SIZE = 4096 * 4  # Scan results for a busy area run to several KB
+
+_counter = itertools.count()
+
+class WpaCtrlError(Exception):
+    pass
+
+class WpaCtrl:
+    """A connection to the control socket of one interface."""
+
+    def __init__(self, interface=INTERFACE, ctrl_dir=None, timeout=REPLY_TIMEOUT):
+        self.path = os.path.join(ctrl_dir or CTRL_DIR, interface)
+        # wpa_supplicant replies to our address, so the socket has to be bound to a path
+        self.local_path = os.path.join(tempfile.gettempdir(), f'wpa_ctrl_{os.getpid()}-{next(_counter)}')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            if os.path.exists(self.local_path):
+                os.remove(self.local_path)
+            self.sock.bind(self.local_path)
+            self.sock.connect(self.path)
+        except OSError:
+            self.close()
+            raise
+        self.timeout = timeout
+        self.sock.settimeout(timeout)
+        self.attached = False
+        self.events = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.attached:
+            try:
+                self.request('DETACH')
+            except OSError:
+                pass
+            self.attached = False
+        self.sock.close()
+        if os.path.exists(self.local_path):
+            os.remove(self.local_path)
+
+    def request(self, command):
+        """Send one command and return wpa_supplicant's reply."""
+        self.sock.send(command.encode('utf-8'))
+        while True:
+            reply = self.sock.recv(BUFFER_SIZE).decode('utf-8', errors='replace')
+            # Unsolicited events start with a <priority>; only attached clients get them
+            if not reply.startswith('<'):
+                return reply
+            self.events.append(strip_priority(reply))
+
+    ############## EVENTS ##############
+
+    def attach(self):
+        """Start receiving events (CTRL-EVENT-...) on this connection."""
+        self.ok('ATTACH')
+        self.attached = True
+
+    def wait_event(self, names, timeout):
+        """
+        Wait up to `timeout` seconds for an event starting with one of `names`, and return
+        its text, or None if none arrived in time. Other events are discarded.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                while self.events:
+                    event = self.events.popleft()
+                    if event.startswith(tuple(names)):
+                        return event
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.sock.settimeout(remaining)
+                try:
+                    message = self.sock.recv(BUFFER_SIZE).decode('utf-8', errors='replace')
+                except socket.timeout:
+                    return None
+                if message.startswith('<'):
+                    self.events.append(strip_priority(message))
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def command(self, command):
+        """Send a command, raising WpaCtrlError if wpa_supplicant rejects it."""
+        reply = self.request(command)
+        if reply.startswith('FAIL') or reply.startswith('UNKNOWN COMMAND'):
+            raise WpaCtrlError(f"'{command.split()[0]}' failed: {reply.strip()}")
+        return reply
+
+    def ok(self, command):
+        reply = self.command(command)
+        if reply.strip() != 'OK':
+            raise WpaCtrlError(f"'{command.split()[0]}' failed: {reply.strip()}")
+
+    ############## COMMANDS ##############
+
+    def ping(self):
+        return self.request('PING').strip() == 'PONG'
+
+    def add_network(self):
+        """Add an empty, disabled network and return its ID."""
+        return self.command('ADD_NETWORK').strip()
+
+    def set_network(self, network_id, name, value):
+        self.ok(f'SET_NETWORK {network_id} {name} {value}')
+
+    def get_network(self, network_id, name):
+        return self.command(f'GET_NETWORK {network_id} {name}').strip()
+
+    def list_networks(self):
+        """Return the saved networks as dicts with id, ssid, bssid and flags."""
+        networks = []
+        for line in self.command('LIST_NETWORKS').splitlines()[1:]:  # Skip the header
+            fields = line.split('\t')
+            if len(fields) >= 3:
+                networks.append({
+                    'id': fields[0],
+                    'ssid': decode_ssid(fields[1]),
+                    'bssid': fields[2],
+                    'flags': fields[3] if len(fields) > 3 else ''
+                })
+        return networks
+
+    def enable_network(self, network_id):
+        self.ok(f'ENABLE_NETWORK {network_id}')
+
+    def remove_network(self, network_id):
+        self.ok(f'REMOVE_NETWORK {network_id}')
+
+    def save_config(self):
+        self.ok('SAVE_CONFIG')
+
+    def reconfigure(self):
+        self.ok('RECONFIGURE')
+
+    def scan(self):
+        """Start a scan. wpa_supplicant refuses (FAIL-BUSY) while one is already running, which is fine."""
+        reply = self.request('SCAN').strip()
+        if reply not in ('OK', 'FAIL-BUSY'):
+            raise WpaCtrlError(f"'SCAN' failed: {reply}")
+
+    def scan_results(self):
+        """Return the latest scan results as dicts with bssid, frequency, signal, flags and ssid."""
+        results = []
+        for line in self.command('SCAN_RESULTS').splitlines()[1:]:  # Skip the header
+            fields = line.split('\t')
+            if len(fields) >= 4:
+                results.append({
+                    'bssid': fields[0],
+                    'frequency': int(fields[1]),
+                    'signal': int(fields[2]),
+                    'flags': fields[3],
+                    'ssid': decode_ssid(fields[4]) if len(fields) > 4 else ''
+                })
+        return results
+
+    def status(self):
+        """Return the interface's STATUS as a dict, e.g. {'wpa_state': 'COMPLETED', 'ssid': ...}."""
+        status = {}
+        for line in self.command('STATUS').splitlines():
+            key, _, value = line.partition('=')
+            status[key] = decode_ssid(value) if key == 'ssid' else value
+        return status
+
+def strip_priority(message):
+    """Turn '<3>CTRL-EVENT-CONNECTED ...' into 'CTRL-EVENT-CONNECTED ...'."""
+    return message[message.find('>') + 1:].strip()
+
+def hex_ssid(ssid):
+    """Encode an SSID for SET_NETWORK so quotes, spaces and non-ASCII characters survive."""
+    return ssid.encode('utf-8').hex()
+
+def decode_ssid(text):
+    """Undo the escaping wpa_supplicant applies to SSIDs in its replies (\\xNN, \\\\, \\" and so on)."""
+    escapes = {'n': b'\n', 'r': b'\r', 't': b'\t', 'e': b'\x1b', '\\': b'\\', '"': b'"'}
+    data = bytearray()
+    i = 0
+    while i < len(text):
+        if text[i] == '\\' and i + 1 < len(text):
+            if text[i + 1] == 'x' and i + 4 <= len(text):
+                try:
+                    data.append(int(text[i + 2:i + 4], 16))
+                    i += 4
+                    continue
+                except ValueError:
+                    pass
+            elif text[i + 1] in escapes:
+                data += escapes[text[i + 1]]
+                i += 2
+                continue
+        data += text[i].encode('utf-8')
+        i += 1
+    return data.decode('utf-8', errors='replace')
+
+############## FAKE ##############
+
+class FakeWpaSupplicant:
+    """
+    A stand-in for wpa_supplicant's control socket, so the Wi-Fi code can be exercised
+    without a radio. It keeps networks in memory, answers the commands WpaCtrl sends,
+    and reports whatever `scan_results` holds. Scans finish, and networks whose
+    passphrase is in `passwords` connect, after the given delays, e.g.
+
+        fake = FakeWpaSupplicant('/tmp/wpa', scan_delay=2).start()
+        fake.scan_results.append(('aa:bb:cc:dd:ee:ff', 2412, -40, '[WPA2-PSK-CCMP][ESS]', 'Home'))
+        fake.passwords['Home'] = 'hunter22'
+
+    and then UNDERWOOD_WPA_CTRL_DIR=/tmp/wpa.
+    """
+
+    def __init__(self, ctrl_dir, interface=INTERFACE, scan_delay=0.1, connect_delay=0.1):
+        self.scan_delay = scan_delay
+        self.connect_delay = connect_delay
+        self.passwords = {}  # ssid -> passphrase
+        self.connected = None  # ssid
+        self.attached = set()
+        self.path = os.path.join(ctrl_dir, interface)
+        os.makedirs(ctrl_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.networks = {}  # id -> {name: value}
+        self.next_id = 0
+        self.scan_results = []  # (bssid, frequency, signal, flags, ssid)
+        self.saved = 0
+        self.commands = []
+
+    def start(self):
+        Thread(target=self.serve, daemon=True).start()
+        return self
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(BUFFER_SIZE)
+            except OSError:
+                return
+            command = data.decode('utf-8')
+            self.commands.append(command)
+            if command == 'ATTACH':
+                self.attached.add(address)
+            elif command == 'DETACH':
+                self.attached.discard(address)
+            self.sock.sendto(self.handle(command).encode('utf-8'), address)
+
+    def emit(self, event):
+        """Send an event to every attached client."""
+        for address in list(self.attached):
+            try:
+                self.sock.sendto(f'<3>{event}'.encode('utf-8'), address)
+            except OSError:
+                self.attached.discard(address)
+
+    def later(self, delay, action):
+        timer = Timer(delay, action)
+        timer.daemon = True
+        timer.start()
+
+    def finish_scan(self):
+        self.emit('CTRL-EVENT-SCAN-RESULTS ')
+
+    def associate(self):
+        """Connect to the highest-priority enabled network that's in range, as wpa_supplicant would."""
+        in_range = {result[4] for result in self.scan_results}
+        candidates = sorted(
+            ((network_id, network) for network_id, network in self.networks.items() if network['disabled'] == '0'),
+            key=lambda item: int(item[1].get('priority', '0')),
+            reverse=True
+        )
+        for network_id, network in candidates:
+            ssid = network_ssid(network)
+            if ssid not in in_range:
+                continue
+            if f'"{self.passwords.get(ssid)}"' == network.get('psk'):
+                self.connected = ssid
+                self.emit(f'CTRL-EVENT-CONNECTED - Connection to 00:00:00:00:00:00 completed [id={network_id} id_str=]')
+            else:
+                self.emit(f'CTRL-EVENT-SSID-TEMP-DISABLED id={network_id} ssid="{ssid}" auth_failures=1 duration=10 reason=WRONG_KEY')
+            return
+        self.emit('CTRL-EVENT-NETWORK-NOT-FOUND')
+
+    def handle(self, command):
+        words = command.split(' ', 3)
+        name = words[0].upper()
+        if name == 'PING':
+            return 'PONG\n'
+        if name == 'ADD_NETWORK':
+            network_id = str(self.next_id)
+            self.next_id += 1
+            self.networks[network_id] = {'priority': '0', 'disabled': '1'}
+            return network_id + '\n'
+        if name in ('SET_NETWORK', 'GET_NETWORK', 'ENABLE_NETWORK', 'REMOVE_NETWORK'):
+            network_id = words[1] if len(words) > 1 else None
+            if network_id not in self.networks and not (name == 'ENABLE_NETWORK' and network_id == 'all'):
+                return 'FAIL\n'
+            if name == 'SET_NETWORK':
+                self.networks[network_id][words[2]] = words[3]
+            elif name == 'GET_NETWORK':
+                value = self.networks[network_id].get(words[2])
+                return 'FAIL\n' if value is None else value
+            elif name == 'ENABLE_NETWORK':
+                for network in (self.networks.values() if network_id == 'all' else [self.networks[network_id]]):
+                    network['disabled'] = '0'
+            else:
+                del self.networks[network_id]
+            return 'OK\n'
+        if name == 'LIST_NETWORKS':
+            lines = ['network id / ssid / bssid / flags']
+            for network_id, network in self.networks.items():
+                ssid = network_ssid(network)
+                lines.append(f"{network_id}\t{ssid}\tany\t{'[DISABLED]' if network['disabled'] == '1' else ''}")
+            return '\n'.join(lines) + '\n'
+        if name == 'SCAN_RESULTS':
+            lines = ['bssid / frequency / signal level / flags / ssid']
+            lines += ['\t'.join(str(field) for field in result) for result in self.scan_results]
+            return '\n'.join(lines) + '\n'
+        if name == 'STATUS':
+            if self.connected is None:
+                return 'wpa_state=DISCONNECTED\n'
+            return f'wpa_state=COMPLETED\nssid={self.connected}\n'
+        if name == 'SAVE_CONFIG':
+            self.saved += 1
+            return 'OK\n'
+        if name == 'SCAN':
+            self.later(self.scan_delay, self.finish_scan)
+            return 'OK\n'
+        if name == 'RECONFIGURE':
+            self.connected = None
+            self.later(self.connect_delay, self.associate)
+            return 'OK\n'
+        if name in ('ATTACH', 'DETACH'):
+            return 'OK\n'
+        return 'UNKNOWN COMMAND\n'
+
+def network_ssid(network):
+    """Read back an SSID set either quoted or hex-encoded."""
+    ssid = network.get('ssid', '')
+    return ssid.strip('"') if ssid.startswith('"') else bytes.fromhex(ssid).decode('utf-8', errors='replace')